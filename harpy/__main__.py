@@ -11,20 +11,32 @@ import os
 import sys
 import time
 import atexit
-import traceback
-import subprocess
-import logging.config
+import functools
 from harpy import data
 from harpy.data import run_main
-from harpy.threads import SendThread, SniffThread
-from harpy.handlers import (ExceptionHandler, EchoHandler, InterfaceHandler,
-                            ParserHandler, ResultHandler, SignalHandler,
-                            SocketHandler, WindowHandler)
+from harpy.threads import (CollectThread, SendThread, SniffThread,
+                           StoreThread, WriteThread)
+from harpy.handlers import (ExceptionHandler, CaptureHandler,
+                            CheckpointHandler, EchoHandler, HostHandler,
+                            InterfaceHandler, InventoryHandler, OutputHandler,
+                            PacerHandler, ParserHandler, QueueHandler,
+                            ResultHandler, SignalHandler, SocketHandler,
+                            StateHandler, WindowHandler)
 
 
 def setup_py_main():
-    if sys.stdin.isatty() and sys.stdout.isatty() and sys.stderr.isatty():
-        if os.getpgrp() == os.tcgetpgrp(sys.stdout.fileno()):
+    setattr(main, data.PARSER, ParserHandler())
+    commands = vars(main)[data.PARSER].create_arguments()
+    vars(main)[data.PARSER].create_links(commands)
+
+    # Replaying a capture file needs no terminal, superuser or interface
+    if data.RPL:
+        replay()
+        terminate()
+    # Headless mode streams to a pipe or a file, no terminal is needed
+    elif data.OUT or (sys.stdin.isatty() and sys.stdout.isatty()
+                      and sys.stderr.isatty()):
+        if data.OUT or os.getpgrp() == os.tcgetpgrp(sys.stdout.fileno()):
             if os.geteuid() == 0:
                 main()
                 terminate()
@@ -43,47 +55,183 @@ def main():
     vars(main)[data.SIGNAL].catch(*data.CATCH_SIGNALS)
     vars(main)[data.SIGNAL].ignore(*data.IGNORE_SIGNALS)
 
-    setattr(main, data.ECHO, EchoHandler())
-    atexit.register(vars(main)[data.ECHO].enable)
-    vars(main)[data.ECHO].disable()
-
-    setattr(main, data.PARSER, ParserHandler())
-    commands = vars(main)[data.PARSER].create_arguments()
-    vars(main)[data.PARSER].create_links(commands)
+    # No terminal to echo to in headless mode
+    if not data.OUT:
+        setattr(main, data.ECHO, EchoHandler())
+        atexit.register(vars(main)[data.ECHO].enable)
+        vars(main)[data.ECHO].disable()
 
     if not vars(main)[data.PARSER].check_arguments():
         sys.exit(1)
 
-    setattr(main, data.SOCKET, SocketHandler(data.SOC_PRO))
+    # Workers? Only then the multiprocessing machinery is needed.
+    if data.FAN or (data.WRK > 1 and not data.PAS):
+        from harpy.processes import SendProcess, SniffProcess, context
+
+    # Bitmaps of the targets, shared if the sending is shared
+    if data.WRK > 1 and not data.PAS:
+        data.STATE = StateHandler(data.RNG,
+                                  functools.partial(context.RawArray, "B"),
+                                  functools.partial(context.RawArray, "L"),
+                                  data.WRK)
+    else:
+        data.STATE = StateHandler(data.RNG)
+
+    # Sniffing workers have their own sockets, this one only sends then
+    setattr(main, data.SOCKET, SocketHandler(0 if data.FAN else data.SOC_PRO))
     vars(main)[data.SOCKET].set_options()
     vars(main)[data.SOCKET].bind(data.INT, data.SOC_POR)
 
     data.SRC_MAC = InterfaceHandler.get_mac(vars(main)[data.SOCKET].l2soc)
     data.SND_MAC = data.SRC_MAC
 
-    setattr(main, data.SNIFF, SniffThread(vars(main)[data.SOCKET].l2soc))
-    vars(main)[data.SNIFF].name = data.SNIFF
-    # Create a container to store all threads and then store one
-    setattr(main, "threads", [vars(main)[data.SNIFF].name])
-    vars(main)[data.SNIFF].start()  # Start sniffing the packets
+    # Sniff results are handed to the main thread through a bounded queue
+    data.RESULT_A = QueueHandler(data.MAX_QUE)
+    if data.WRF:
+        data.WRITE_A = QueueHandler(data.MAX_WRQ)  # Raw frames to be written
+
+    # Let the kernel drop the packets that sniff() would throw away anyway
+    vars(main)[data.SOCKET].set_filter(data.SRC_MAC)
+
+    # Receive ring requested but not supported? Fall back to recv.
+    # Sniffing workers map their own rings.
+    if data.RXM == "ring" and not data.FAN:
+        if not vars(main)[data.SOCKET].set_ring():
+            data.RXM = data.RX_MODES[0]
+
+    # Create a container to store all threads
+    setattr(main, "threads", list())
+
+    # Sniffing workers? Fork before any thread is started.
+    for _ in range(data.FAN):
+        name = "%s-%d" % (data.SNIFF_PROC, _)
+        setattr(main, name, SniffProcess(os.getpid()))
+        vars(main)[name].name = name
+        vars(main)["threads"].append(name)
+        vars(main)[name].start()  # Start sniffing the packets
+        vars(main)[name].writer.close()  # Only the worker writes
+
+    # Send nothing before the workers sniff, the first replies are missed
+    for _ in range(data.FAN):
+        vars(main)["%s-%d" % (data.SNIFF_PROC, _)].ready.wait(data.WAIT_MAIN)
+
+    # Hierarchical mode? All senders expand the /24s that have answered.
+    if data.HIE:
+        if data.WRK > 1:
+            data.ANSWERED = context.RawArray("B", data.ANSWERED_SIZ)
+        else:
+            data.ANSWERED = bytearray(data.ANSWERED_SIZ)
+
+    # Checkpoint? Resumed hosts must be marked before anything is sent.
+    if data.CHK:
+        setattr(main, data.CHECKPOINT, CheckpointHandler(data.CHK))
+        if data.RESUME:
+            vars(main)[data.CHECKPOINT].mark()
+
+    # Active mode with sharded sending? Fork before any thread is started.
+    if not data.PAS and data.WRK > 1:
+        # Transmit ring not supported? No worker tries it, all use send.
+        if data.TXM == "ring":
+            probe = SocketHandler(0)
+            probe.bind(data.INT, data.SOC_POR)
+            if not probe.set_tx_ring():
+                fall_back_tx()
+            probe.close()
+
+        # All workers take their tokens from one global budget
+        data.PACER = PacerHandler(data.PPS, data.BAT, context.Array("d", 3))
+        for _ in range(data.WRK):
+            name = "%s-%d" % (data.SEND_PROC, _)
+            setattr(main, name, SendProcess(_, data.WRK))
+            vars(main)[name].name = name
+            vars(main)["threads"].append(name)
+            vars(main)[name].start()  # Start sending the packets
+
+    if data.FAN:
+        # Collect the results of the sniffing workers into the queue
+        setattr(main, data.COLLECT, CollectThread([
+            vars(main)[_].reader for _ in vars(main)["threads"]
+            if _.startswith(data.SNIFF_PROC)
+        ]))
+        vars(main)[data.COLLECT].name = data.COLLECT
+        vars(main)["threads"].append(vars(main)[data.COLLECT].name)
+        vars(main)[data.COLLECT].start()  # Start collecting the results
+    else:
+        setattr(main, data.SNIFF, SniffThread(vars(main)[data.SOCKET].l2soc,
+                                              vars(main)[data.SOCKET].ring))
+        vars(main)[data.SNIFF].name = data.SNIFF
+        vars(main)["threads"].append(vars(main)[data.SNIFF].name)
+        vars(main)[data.SNIFF].start()  # Start sniffing the packets
+
+    # Joined after the sniffing, so the last frames are written too
+    if data.WRF:
+        setattr(main, data.WRITE, WriteThread(
+            data.WRF, data.WRS and data.WRS * 2 ** 20, data.WRT
+        ))
+        vars(main)[data.WRITE].name = data.WRITE
+        vars(main)["threads"].append(vars(main)[data.WRITE].name)
+        vars(main)[data.WRITE].start()  # Start writing the packets
 
     # Active mode?
-    if not data.PAS:
-        setattr(main, data.SEND, SendThread(vars(main)[data.SOCKET].l2soc))
+    if not data.PAS and data.WRK == 1:
+        sender = vars(main)[data.SOCKET]  # Socket to send the packets from
+        if data.TXM == "ring":
+            # Transmit ring needs its own socket, one that receives nothing
+            setattr(main, data.SOCKET_TX, SocketHandler(0))
+            vars(main)[data.SOCKET_TX].set_options()
+            vars(main)[data.SOCKET_TX].bind(data.INT, data.SOC_POR)
+            # Transmit ring not supported? Fall back to send.
+            if vars(main)[data.SOCKET_TX].set_tx_ring():
+                sender = vars(main)[data.SOCKET_TX]
+            else:
+                # No idle socket left open until exiting
+                vars(main)[data.SOCKET_TX].close()
+                delattr(main, data.SOCKET_TX)
+                fall_back_tx()
+        if data.BYP:
+            sender.set_bypass()
+
+        data.PACER = PacerHandler(data.PPS, data.BAT)
+        # The receive ring of the sniffing socket is not for sending
+        setattr(main, data.SEND, SendThread(
+            sender.l2soc, sender.ring if data.TXM == "ring" else None
+        ))
         vars(main)[data.SEND].name = data.SEND
         vars(main)["threads"].append(vars(main)[data.SEND].name)
         vars(main)[data.SEND].start()  # Start sending the packets
 
+    # Inventory? Known hosts must be loaded before the host table is created.
+    if data.INV:
+        inventory()
+
     # This line is not in loop for performance
     setattr(main, data.RESULT, ResultHandler())
+    data.RESULT_ALL = HostHandler()
+    if data.RESUME:
+        vars(main)[data.CHECKPOINT].restore(vars(main)[data.RESULT],
+                                            data.RESULT_ALL)
+
+    # Headless mode? Stream the hosts instead of drawing the window.
+    if data.OUT:
+        setattr(main, data.OUTPUT, OutputHandler(data.OUT, data.OUF))
+    else:
+        setattr(main, data.WINDOW, WindowHandler(data.RESULT_ALL))
 
+    finished = False  # Sending finished at the previous step
     time_timeout = time.time()  # Countdown start time
     while data.RUN_MAIN:
         vars(main)[data.SIGNAL].ignore(*data.IGNORE_SIGNALS)
-        setattr(main, data.WINDOW, WindowHandler(data.RESULT_ALL))
-        subprocess.call(["clear"])  # Better than os.system
-        vars(main)[data.WINDOW].draw_skeleton()
-        vars(main)[data.WINDOW]()
+        follow_workers()
+        if data.CHK:
+            vars(main)[data.CHECKPOINT](get_cursors())
+        if data.OUT:
+            # Late replies had a whole step to arrive, nothing more to wait
+            if finished:
+                data.finish("Exiting, sending finished")
+                run_main(False)
+            finished = data.TGT_IP is False
+        else:
+            vars(main)[data.WINDOW]()  # Only the rows that have changed
         vars(main)[data.SIGNAL].catch(*data.CATCH_SIGNALS)
 
         time_main = time.time()  # Create a new one at every step
@@ -93,13 +241,140 @@ def main():
             # Improve packet sending performance in other thread
             time.sleep(float(1) / 100)  # Float division for 2.7
 
-            if data.RESULT_A:
-                result = data.RESULT_A.pop(0)
-                vars(main)[data.RESULT].snd_ip = result[0]
-                vars(main)[data.RESULT].src_mac = result[1]
-                vars(main)[data.RESULT].snd_mac = result[2]
-                vars(main)[data.RESULT].arp_opc = result[3]
-                data.RESULT_ALL = vars(main)[data.RESULT](data.RESULT_ALL)
+            aggregate()  # Everything sniffed since the last step at once
+
+            if data.OUT:
+                vars(main)[data.OUTPUT].flush()  # At most one write per step
+            # Scrolled or resized? Redraw now, not at the next step.
+            elif vars(main)[data.WINDOW].poll():
+                vars(main)[data.SIGNAL].ignore(*data.IGNORE_SIGNALS)
+                vars(main)[data.WINDOW](False)
+                vars(main)[data.SIGNAL].catch(*data.CATCH_SIGNALS)
+
+
+def replay():
+    """Runs a capture file through the sniff pipeline at disk speed."""
+
+    sys.excepthook = terminate_hard
+
+    setattr(main, data.SIGNAL, SignalHandler())
+    vars(main)[data.SIGNAL].catch(*data.CATCH_SIGNALS)
+    vars(main)[data.SIGNAL].ignore(*data.IGNORE_SIGNALS)
+
+    if not vars(main)[data.PARSER].check_arguments():
+        sys.exit(1)
+
+    data.STATE = StateHandler(data.RNG)
+    # No MAC address of yours in a capture file, so nothing is skipped
+    data.SRC_MAC = data.SND_MAC = "00" * 6
+
+    setattr(main, "threads", list())
+    if data.INV:
+        inventory()
+
+    # Only the parser of the sniff thread is used, it is never started
+    data.RESULT_A = QueueHandler(data.MAX_QUE)
+    sniffer = SniffThread(None)
+    setattr(main, data.RESULT, ResultHandler())
+    data.RESULT_ALL = HostHandler()
+    setattr(main, data.OUTPUT, OutputHandler(data.OUT, data.OUF))
+
+    capture = CaptureHandler(data.RPL)
+    buffer = capture.capture  # Parsed in place, never copied
+    for index, (offset, stamp) in enumerate(capture, 1):
+        # The capture times, not the replay ones, go to the output
+        sniffer.sniff(buffer, offset, None, stamp)
+        # Drain before the queue can drop anything, a file can wait
+        if not index % data.POOL_NR:
+            aggregate()
+            vars(main)[data.OUTPUT].flush()
+            if not data.RUN_MAIN:
+                break
+    aggregate()
+    vars(main)[data.OUTPUT].flush()
+    vars(main)[data.OUTPUT].end = capture.stamp
+
+    data.RX_FRAMES = capture.frames
+    if data.RUN_MAIN:
+        data.finish("Exiting, %d frames replayed" % capture.frames)
+    capture.close()
+
+
+def inventory():
+    """Loads the known hosts for a warm start, starts storing the hosts."""
+
+    if data.WRM:
+        known = InventoryHandler(data.INV)
+        data.KNOWN = known.load()
+        known.close()
+
+    data.STORE_A = QueueHandler(data.MAX_QUE)
+    setattr(main, data.STORE, StoreThread(data.INV))
+    vars(main)[data.STORE].name = data.STORE
+    vars(main)["threads"].append(vars(main)[data.STORE].name)
+    vars(main)[data.STORE].start()  # Start storing the hosts
+
+
+def fall_back_tx():
+    """Falls back to the first transmit mode, tells it on exit."""
+
+    data.EXIT_MSGS.add("Transmit ring not supported, sent with %s"
+                       % data.TX_MODES[0])
+    data.TXM = data.TX_MODES[0]
+
+
+def aggregate():
+    """Aggregates the sniff results waiting in the queue."""
+
+    for result in data.RESULT_A.drain():
+        vars(main)[data.RESULT].snd_ip = result[0]
+        vars(main)[data.RESULT].src_mac = result[1]
+        vars(main)[data.RESULT].snd_mac = result[2]
+        vars(main)[data.RESULT].arp_opc = result[3]
+        vars(main)[data.RESULT].stamp = result[4]
+        data.RESULT_ALL = vars(main)[data.RESULT](data.RESULT_ALL)
+        if data.OUT:
+            vars(main)[data.OUTPUT].add(vars(main)[data.RESULT].host)
+        if data.STORE_A is not None:
+            store(vars(main)[data.RESULT].host)
+
+
+def store(host):
+    """
+    Queues a host to be stored, unless it is already waiting to be stored,
+    the store thread reads its counters only when storing it.
+
+    :param host: Host that has been seen.
+    """
+
+    pending = vars(main)[data.STORE].pending
+    if id(host) not in pending:
+        pending.add(id(host))
+        # Queue full? Queue it again the next time it is seen.
+        if not data.STORE_A.put(host):
+            pending.discard(id(host))
+
+
+def follow_workers():
+    """Shows the target of the first sending worker that is still alive."""
+
+    if not data.PAS and data.WRK > 1:
+        for _ in vars(main)["threads"]:
+            if _.startswith(data.SEND_PROC) and vars(main)[_].is_alive():
+                data.TGT_IP = vars(main)[_].cursor[3]
+                return
+        data.TGT_IP = False  # All workers have finished
+
+
+def get_cursors():
+    """Returns the cursors of the senders, shard by shard."""
+
+    if data.PAS:
+        return list()
+    if data.WRK > 1:
+        return [list(vars(main)[_].cursor) for _ in vars(main)["threads"]
+                if _.startswith(data.SEND_PROC)]
+    return [list(vars(main)[data.SEND].cursor)]
 
 
 @ExceptionHandler()
@@ -116,14 +391,31 @@ def terminate():
         vars(main)[_].flag.set()  # Tell the thread to terminate itself
         vars(main)[_].join()
 
-    if hasattr(main, data.SOCKET):
-        vars(main)[data.SOCKET].close()  # Close the socket
+    for _ in (data.SOCKET, data.SOCKET_TX):
+        if hasattr(main, _):
+            vars(main)[_].close()  # Close the socket
+
+    # Signal, timeout or error? Save where the sweep stopped to resume it.
+    if hasattr(main, data.CHECKPOINT) and hasattr(main, data.RESULT):
+        vars(main)[data.CHECKPOINT](get_cursors(), True)
 
-    print("\n")
+    if data.RESULT_A is not None and data.RESULT_A.dropped:
+        data.EXIT_MSGS.add("Result queue was full, %d results dropped"
+                           % data.RESULT_A.dropped)
+
+    # Headless mode? Stdout is for the hosts, not for the messages.
+    if hasattr(main, data.OUTPUT):
+        vars(main)[data.OUTPUT].close()
+        stream = sys.stderr
+    else:
+        if hasattr(main, data.WINDOW):
+            vars(main)[data.WINDOW].close()  # Print below the window
+        print("\n")
+        stream = sys.stdout
     for _ in data.EXIT_MSGS:
-        print(_)
-    sys.stdout.flush()
-    sys.exit(1)
+        print(_, file=stream)
+    stream.flush()
+    sys.exit(1 if data.EXIT_CODE is None else data.EXIT_CODE)
 
 
 def terminate_hard(*args):
@@ -133,15 +425,22 @@ def terminate_hard(*args):
     :param args: Container that stores type, value and traceback.
     """
 
+    import traceback  # Not needed until something goes wrong
+    import logging.config
+
     log_conf_file = os.path.join(os.path.dirname(__file__), "logging.conf")
     logging.config.fileConfig(log_conf_file)
     logger = logging.getLogger("harpy")
     logger.error("%s\n", traceback.format_exception(args[0], args[1], args[2]))
 
     # atexit.register will not work when os._exit is called, so...
-    getattr(main, data.ECHO, EchoHandler()).enable()
-    if hasattr(main, data.SOCKET):
-        vars(main)[data.SOCKET].close()
+    if hasattr(main, data.ECHO):
+        vars(main)[data.ECHO].enable()
+    if hasattr(main, data.WINDOW):
+        vars(main)[data.WINDOW].close()
+    for _ in (data.SOCKET, data.SOCKET_TX):
+        if hasattr(main, _):
+            vars(main)[_].close()
     vars(os)["_exit"](34)  # Force exiting with code 34
 
 
@@ -0,0 +1,566 @@
+# coding=utf-8
+
+# This file is part of hARPy
+# Released under the MIT license
+# Copyright (C) Serhat Çelik
+
+"""
+Benchmarks of hARPy, no superuser or network device is needed:
+
+    python -m harpy.bench [stage ...]
+
+Every stage is fed synthetic packets and hosts, the same ones in every run,
+so the results of different versions can be compared.
+"""
+
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+import random
+import select
+import shutil
+import socket
+import struct
+import argparse
+import platform
+import tempfile
+import subprocess
+from harpy import __license__, data
+
+BENCH_IFACE = "bench"  # Prefix of the fake interfaces
+BENCH_MAC = "020000000001"  # MAC address of the fake interface
+BENCH_SEED = 43  # Same synthetic packets and hosts in every run
+BENCH_RING_HDR = 64  # Offset of the first frame in a block, of the MAC
+BENCH_RING_FRM = 128  # Size of a frame in the fake ring
+STAGES = ["startup", "build", "parse", "receive", "aggregate", "render"]
+
+
+def get_percentiles(samples, count=1):
+    """
+    Summarises the durations of a benchmark.
+
+    :param samples: Durations in seconds.
+    :param count: Number of items processed in every sample.
+    """
+
+    samples = sorted(samples)
+
+    def get(percent):
+        return round(samples[int(percent * (len(samples) - 1))] * 1000, 4)
+
+    return {
+        "samples": len(samples),
+        "min_ms": get(0),
+        "p50_ms": get(0.5),
+        "p90_ms": get(0.9),
+        "p99_ms": get(0.99),
+        "max_ms": get(1),
+        "per_sec": round(count / max(samples[len(samples) // 2], 1e-9), 1),
+    }
+
+
+def create_sysfs(path, interfaces):
+    """
+    Creates a fake interface directory, every interface is up.
+
+    :param path: Directory to be created.
+    :param interfaces: Number of interfaces.
+    """
+
+    for _ in range(interfaces):
+        os.makedirs(os.path.join(path, "%s%d" % (BENCH_IFACE, _)))
+        with open(os.path.join(path, "%s%d" % (BENCH_IFACE, _),
+                               "operstate"), "w") as operstate:
+            operstate.write("up\n")
+
+
+def create_log(path, size):
+    """
+    Creates a fake log file.
+
+    :param path: File to be created.
+    :param size: Size of the file in MB.
+    """
+
+    line = "Jan 01 2021 00:00:00 harpy MainThread ERROR: %s\n" % ("x" * 64)
+    with open(path, "w") as log:
+        for _ in range(size * 2 ** 20 // len(line)):
+            log.write(line)
+
+
+def bench_startup(repeat, interfaces, log_size):
+    """
+    Measures the path from the command to the first packet to be sent,
+    except for opening the socket.
+
+    :param repeat: Number of samples.
+    :param interfaces: Number of fake interfaces.
+    :param log_size: Size of the fake log file in MB.
+    """
+
+    from harpy.handlers import PacketHandler, ParserHandler, StateHandler
+
+    results = dict()
+
+    # A fresh interpreter for every sample, as from the command line
+    samples = list()
+    for _ in range(repeat):
+        start = time.time()
+        subprocess.check_call([sys.executable, "-c", "import harpy.__main__"])
+        samples.append(time.time() - start)
+    results["startup.import"] = get_percentiles(samples)
+
+    temp = tempfile.mkdtemp()
+    sys_path, log_file, argv = data.SYS_PATH, data.LOG_FILE, sys.argv
+    if_nameindex = vars(socket).pop("if_nameindex", None)
+    try:
+        data.SYS_PATH = os.path.join(temp, "net")
+        data.LOG_FILE = os.path.join(temp, "harpy.log")
+        create_sysfs(data.SYS_PATH, interfaces)
+        create_log(data.LOG_FILE, log_size)
+
+        # The given interface only, or all of them walked to pick one (the
+        # fake ones are not known to if_nameindex, the directory is listed)
+        last = "%s%d" % (BENCH_IFACE, interfaces - 1)
+        for name, interface in [("startup.main", ["-i", last]),
+                                ("startup.discover", [])]:
+            sys.argv = ["harpy"] + interface
+            samples = list()
+            for _ in range(repeat):
+                start = time.time()
+                parser = ParserHandler()
+                parser.create_links(parser.create_arguments())
+                parser.check_arguments()
+                data.STATE = StateHandler(data.RNG)
+                data.SRC_MAC = data.SND_MAC = "02%010x" % _  # Never cached
+                PacketHandler.create_template()
+                samples.append(time.time() - start)
+            results[name] = get_percentiles(samples)
+    finally:
+        data.SYS_PATH, data.LOG_FILE, sys.argv = sys_path, log_file, argv
+        if if_nameindex is not None:
+            socket.if_nameindex = if_nameindex
+        shutil.rmtree(temp)
+
+    return results
+
+
+def create_frames(count, hosts):
+    """
+    Creates ARP replies/requests of random hosts in the 10.0.0.0/8 range.
+
+    :param count: Number of frames.
+    :param hosts: Number of different hosts.
+    """
+
+    rand = random.Random(BENCH_SEED)
+
+    frames = list()
+    for _ in range(count):
+        host = rand.randrange(hosts)
+        mac = struct.pack("!HI", 0x0200, host)
+        frames.append(
+            b"\xff" * 6 + mac + b"\x08\x06"  # Ethernet
+            + b"\x00\x01\x08\x00\x06\x04"  # ARP, fixed fields
+            + struct.pack("!H", rand.choice([1, 2])) + mac  # Opcode, sender
+            + struct.pack("!I", 0x0a000001 + host)  # Sender IP address
+            + b"\x00" * 10 + b"\x00" * 18  # Target, padding
+        )
+    return frames
+
+
+def create_hosts(count):
+    """
+    Creates a host table.
+
+    :param count: Number of hosts.
+    """
+
+    from harpy.handlers import Host, HostHandler
+
+    hosts = HostHandler()
+    for _ in range(count):
+        mac = "0200%08x" % _
+        host = Host("10.%d.%d.%d" % (_ >> 16 & 0xff, _ >> 8 & 0xff, _ & 0xff),
+                    mac, mac, "unknown", "unknown")
+        hosts.add(host)
+        hosts.count(host, True)
+    return hosts
+
+
+def set_up():
+    """Sets the links as if the default command was given."""
+
+    from harpy.handlers import ArgumentHandler, QueueHandler, StateHandler
+
+    data.SRC_MAC = data.SND_MAC = BENCH_MAC
+    data.NOD = data.DEF_NOD
+    data.PPS = data.SLP = data.DEF_SLP
+    data.RXM = data.DEF_RXM
+    data.TGT_IP = None
+    data.FLT = data.FST = data.HIE = data.REP = None
+    ArgumentHandler.handle_range(["10.0.0.1/8"], None)
+    data.STATE = StateHandler(data.RNG)
+    data.RESULT_A = QueueHandler(data.MAX_QUE)
+
+
+def bench_build(repeat, batch):
+    """
+    Measures building the requests, one for every target.
+
+    :param repeat: Number of samples.
+    :param batch: Number of requests in every sample.
+    """
+
+    from harpy.data import get_sender, get_targets
+    from harpy.handlers import PacketHandler
+
+    targets = list(get_targets(data.RNG[0]))[:batch]
+
+    samples = list()
+    for _ in range(repeat):
+        start = time.time()
+        template = PacketHandler.create_template()
+        for target in targets:
+            PacketHandler.patch_template(template, get_sender(target), target)
+        samples.append(time.time() - start)
+    return {"build.request": get_percentiles(samples, len(targets))}
+
+
+def bench_parse(repeat, batch, hosts):
+    """
+    Measures parsing the frames, with and without filtering.
+
+    :param repeat: Number of samples.
+    :param batch: Number of frames in every sample.
+    :param hosts: Number of different hosts that sent the frames.
+    """
+
+    from harpy.threads import SniffThread
+
+    sniffer = SniffThread(None)
+    frames = bytearray(b"".join(create_frames(batch, hosts)))
+    size = len(frames) // batch
+
+    results = dict()
+    for name, filtering in [("parse.frame", None), ("parse.filter", True)]:
+        data.FLT = filtering
+        samples = list()
+        for _ in range(repeat):
+            start = time.time()
+            for offset in range(0, len(frames), size):
+                sniffer.sniff(frames, offset)
+            samples.append(time.time() - start)
+            data.RESULT_A.drain()
+        results[name] = get_percentiles(samples, batch)
+    data.FLT = None
+
+    return results
+
+
+def create_ring(frames):
+    """
+    Creates a receive ring whose blocks are owned by the user, filled with
+    frames the way the kernel does.
+
+    :param frames: Frames to be received.
+    """
+
+    ring = bytearray(data.RING_BLK_SIZ * data.RING_BLK_NR)
+    per_block = (data.RING_BLK_SIZ - BENCH_RING_HDR) // BENCH_RING_FRM
+
+    blocks = list()
+    for start in range(0, len(frames), per_block):
+        block = len(blocks) * data.RING_BLK_SIZ
+        chunk = frames[start:start + per_block]
+        struct.pack_into("II", ring, block + data.RING_BLK_PKT, len(chunk),
+                         BENCH_RING_HDR)
+        for index, frame in enumerate(chunk):
+            offset = block + BENCH_RING_HDR + index * BENCH_RING_FRM
+            # Next offset, time, lengths, status and MAC offset of the frame
+            struct.pack_into("IIIIIIH", ring, offset, BENCH_RING_FRM, 0, 0,
+                             len(frame), len(frame), 0, BENCH_RING_HDR)
+            ring[offset + BENCH_RING_HDR:offset + BENCH_RING_HDR
+                 + len(frame)] = frame
+        blocks.append(block)
+    return ring, blocks
+
+
+def bench_receive(repeat, batch, hosts):
+    """
+    Measures the receive loops, and the new buffers every frame is handed
+    over in (Python 3 only), from a socket pair and from a fake ring.
+
+    :param repeat: Number of samples.
+    :param batch: Number of frames in every sample.
+    :param hosts: Number of different hosts that sent the frames.
+    """
+
+    from harpy.threads import SniffThread
+
+    per_ring = ((data.RING_BLK_SIZ - BENCH_RING_HDR) // BENCH_RING_FRM
+                * data.RING_BLK_NR)
+    frames = create_frames(min(batch, per_ring), hosts)
+    ring, blocks = create_ring(frames)
+
+    # The sniffer keeps every buffer, so a new one stays allocated
+    kept = [None] * len(frames)
+    counter = [0]
+
+    def keep(packet, *args):
+        kept[counter[0]] = packet
+        counter[0] += 1
+        if counter[0] == count:
+            sniffer.flag.set()
+
+    results = dict()
+    for mode in ["recv", "batch", "ring"]:
+        reader, writer = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+        reader.setblocking(False)
+        writer.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 2 ** 24)
+        writer.setblocking(False)
+
+        sniffer = SniffThread(reader, ring if mode == "ring" else None)
+        sniffer.sniff = keep
+        data.RXM = mode
+        loop = {"recv": sniffer.recv_loop, "batch": sniffer.recv_batch,
+                "ring": sniffer.walk_ring}[mode]
+
+        samples, blocks_per_frame = list(), list()
+        for _ in range(repeat):
+            count = len(frames)
+            if mode == "ring":
+                for block in blocks:
+                    struct.pack_into("I", ring, block + data.RING_BLK_STA,
+                                     data.TP_STATUS_USER)
+            else:
+                # As many as the socket can hold
+                for index, frame in enumerate(frames):
+                    try:
+                        writer.send(frame)
+                    except socket.error:
+                        count = index
+                        break
+            counter[0] = 0
+            kept[:] = [None] * len(frames)
+            sniffer.flag.clear()
+
+            allocated = getattr(sys, "getallocatedblocks", int)()
+            start = time.time()
+            loop()
+            samples.append(time.time() - start)
+            blocks_per_frame.append(
+                (getattr(sys, "getallocatedblocks", int)() - allocated)
+                / float(count)
+            )
+
+            # Leftovers of a short sample are not for the next one
+            while select.select([reader], [], [], 0)[0]:
+                reader.recv(data.SOC_BUF)
+
+        reader.close()
+        writer.close()
+        results["receive.%s" % mode] = get_percentiles(samples, count)
+        if hasattr(sys, "getallocatedblocks"):
+            blocks_per_frame.sort()
+            results["receive.%s" % mode]["blocks_per_frame"] = round(
+                blocks_per_frame[len(blocks_per_frame) // 2], 3
+            )
+    data.RXM = data.DEF_RXM
+
+    return results
+
+
+def bench_aggregate(repeat, batch, sizes):
+    """
+    Measures aggregating the results into host tables of different sizes.
+
+    :param repeat: Number of samples.
+    :param batch: Number of results in every sample.
+    :param sizes: Numbers of hosts already in the table.
+    """
+
+    from harpy.handlers import ResultHandler
+
+    handler = ResultHandler()
+
+    results = dict()
+    for size in sizes:
+        # Half of the results are of known hosts, half are of new ones
+        sniffer_results = list()
+        for i, frame in enumerate(create_frames(batch, max(size, 1) * 2)):
+            opcode, mac, ip_addr = struct.unpack_from("!H6s4s", frame, 20)
+            mac = "".join("%02x" % _ for _ in bytearray(mac))
+            sniffer_results.append(("%d.%d.%d.%d" % tuple(bytearray(ip_addr)),
+                                    mac, mac, "%04x" % opcode))
+
+        samples = list()
+        for _ in range(repeat):
+            hosts = create_hosts(size)
+            start = time.time()
+            for result in sniffer_results:
+                handler.snd_ip, handler.src_mac = result[0], result[1]
+                handler.snd_mac, handler.arp_opc = result[2], result[3]
+                handler(hosts)
+            samples.append(time.time() - start)
+        results["aggregate.hosts_%d" % size] = get_percentiles(samples, batch)
+
+    return results
+
+
+def bench_render(repeat, sizes, columns=120, lines=50):
+    """
+    Measures redrawing the result window, without a terminal.
+
+    :param repeat: Number of samples.
+    :param sizes: Numbers of hosts in the table.
+    :param columns: Width of the fake terminal.
+    :param lines: Height of the fake terminal.
+    """
+
+    from harpy.handlers import WindowHandler
+
+    class Sink(object):
+        written = 0
+
+        def write(self, text):
+            Sink.written += len(text)
+
+        def flush(self):
+            pass
+
+    stdout, get_size = sys.stdout, WindowHandler.get_size
+    results = dict()
+    try:
+        sys.stdout = Sink()
+        WindowHandler.get_size = staticmethod(lambda: (columns, lines))
+        for size in sizes:
+            hosts = create_hosts(size)
+            window = WindowHandler(hosts)
+            window()
+
+            # Scrolling reuses the skeleton, a step rebuilds it after a change
+            for name, step in [("scroll", False), ("step", True)]:
+                samples = list()
+                written = Sink.written
+                for _ in range(repeat):
+                    if step:
+                        hosts.count(hosts.order[window.top], True)
+                    start = time.time()
+                    window(step)
+                    samples.append(time.time() - start)
+                results["render.%s_%d" % (name, size)] = get_percentiles(
+                    samples
+                )
+                results["render.%s_%d" % (name, size)]["bytes"] = (
+                    (Sink.written - written) // repeat
+                )
+    finally:
+        sys.stdout, WindowHandler.get_size = stdout, get_size
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="python -m harpy.bench",
+        description="Benchmarks of hARPy, results are printed as JSON",
+    )
+    parser.add_argument(
+        "stages", nargs="*", metavar="stage", default=STAGES,
+        help="stages to benchmark, any of: %s (def:all)" % ", ".join(STAGES),
+    )
+    parser.add_argument(
+        "-b", default=1000, type=int, metavar="batch", dest="b",
+        help="number of packets/results in every sample (def:%(default)s)",
+    )
+    parser.add_argument(
+        "-r", default=20, type=int, metavar="repeat", dest="r",
+        help="number of samples of every benchmark (def:%(default)s)",
+    )
+    parser.add_argument(
+        "--hosts", default=[10, 1000, 50000], type=int, nargs="+",
+        metavar="count", dest="hosts",
+        help="sizes of the host tables (def:10 1000 50000)",
+    )
+    parser.add_argument(
+        "--interfaces", default=500, type=int, metavar="count",
+        dest="interfaces",
+        help="number of fake interfaces (def:%(default)s)",
+    )
+    parser.add_argument(
+        "--log-size", default=64, type=int, metavar="MB", dest="log_size",
+        help="size of the fake log file (def:%(default)s)",
+    )
+    parser.add_argument(
+        "--budget", default=500, type=float, metavar="ms", dest="budget",
+        help="time from the command to the first packet, exit with 1 if "
+             "the p90 exceeds it (def:%(default)s)",
+    )
+    parser.add_argument(
+        "--baseline", metavar="file", dest="baseline",
+        help="results of another version to compare the p50s with",
+    )
+    commands = parser.parse_args()
+
+    unknown = [_ for _ in commands.stages if _ not in STAGES]
+    if unknown:
+        parser.error("unknown stage(s): %s" % ", ".join(unknown))
+    repeat = max(commands.r, 1)
+    batch = max(commands.b, 1)
+    sizes = [max(_, 1) for _ in commands.hosts]
+
+    results = dict()
+    if "startup" in commands.stages:
+        results.update(bench_startup(repeat, max(commands.interfaces, 1),
+                                     max(commands.log_size, 0)))
+    set_up()
+    if "build" in commands.stages:
+        results.update(bench_build(repeat, batch))
+    if "parse" in commands.stages:
+        results.update(bench_parse(repeat, batch, max(sizes)))
+    if "receive" in commands.stages:
+        results.update(bench_receive(repeat, batch, max(sizes)))
+    if "aggregate" in commands.stages:
+        results.update(bench_aggregate(repeat, batch, sizes))
+    if "render" in commands.stages:
+        results.update(bench_render(repeat, sizes))
+
+    report = {
+        "version": __license__.VERSION,
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "parameters": {"batch": batch, "repeat": repeat, "hosts": sizes},
+        "benchmarks": results,
+    }
+
+    # Compare with the same benchmarks of another version
+    if commands.baseline:
+        with open(commands.baseline, "r") as baseline:
+            baseline = json.load(baseline)["benchmarks"]
+        for name, result in results.items():
+            if name in baseline and baseline[name]["p50_ms"]:
+                result["p50_change_pct"] = round(
+                    (result["p50_ms"] / baseline[name]["p50_ms"] - 1) * 100, 1
+                )
+
+    over_budget = False
+    if "startup" in commands.stages:
+        startup = (results["startup.import"]["p90_ms"]
+                   + max(results["startup.main"]["p90_ms"],
+                         results["startup.discover"]["p90_ms"]))
+        over_budget = startup > commands.budget
+        report["budget"] = {"startup_ms": round(startup, 4),
+                            "budget_ms": commands.budget,
+                            "ok": not over_budget}
+
+    print(json.dumps(report, indent=2, sort_keys=True))
+
+    if over_budget:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
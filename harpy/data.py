@@ -4,28 +4,104 @@
 # Released under the MIT license
 # Copyright (C) Serhat Çelik
 
+import socket
+import struct
 
 ################
 # Over Control #
 ################
 RUN_MAIN = True
 EXIT_MSGS = set()  # Container for storing exit messages
+EXIT_CODE = None  # 0 if finished normally, 1 if an error has occurred
 FAST_NODE = [1, 2, 100, 127, 200, 254]
 
 # Flicker reduction times (in seconds)
 WAIT_MAIN = 2
 WAIT_SEND = float(2) / 10
 WAIT_SNIFF = float(1) / 10
+WAIT_PACE = float(1) / 1000  # Shortest sleep of the pacer, shorter is a burst
+WAIT_RATE = 5  # Achieved rate is measured over this many last seconds
+WAIT_SHIP = float(1) / 100  # Sniffing workers ship their results this often
+WAIT_WRITE = float(1) / 2  # Write thread writes the sniffed frames this often
+WAIT_STORE = 1  # Store thread stores the seen hosts this often
+WAIT_CHECK = 30  # Main thread saves a checkpoint this often
+
+# Pacer
+PACER = None  # Token bucket that paces the send thread
+WIRE_BITS = (60 + 4 + 8 + 12) * 8  # Request + FCS + preamble + gap on wire
 
 # Results
-RESULT_A = list()  # Container for storing a sniff result
-RESULT_ALL = list()  # Container for storing all sniff results
+RESULT_A = None  # Queue for handing the sniff results to the main thread
+RESULT_ALL = None  # Host table for storing all sniff results
+WRITE_A = None  # Queue for handing the raw ARP frames to the write thread
+STORE_A = None  # Queue for handing the seen hosts to the store thread
+KNOWN = None  # Hosts of the inventory: (IP, Ethernet MAC, ARP MAC) -> vendors
+
+# Hierarchical sweep
+ANSWERED = None  # Bitmap of the /24 networks that have answered
+ANSWERED_SIZ = 2 ** 24 // 8  # One bit for every /24 network
+
+# Targets
+STATE = None  # Probed/answered/retried bitmaps of all targets
+
+# Checkpoint
+RESUME = None  # Checkpoint resumed from: cursors of the senders and hosts
+SWEPT = [2, 0, 0, 0]  # Cursor past the last phase, nothing left to send
+
+# Receive counters
+RX_FRAMES = 0  # Number of packets received
 
 #############
 # Locations #
 #############
 SYS_PATH = "/sys/class/net/"  # Directory that stores all interfaces
 LOG_FILE = "/var/log/harpy.log"
+OUI_FILE = "ouis.idx"  # In the package directory
+
+#############
+# OUI Index #
+#############
+OUI_MAGIC = b"OUI1"
+OUI_HDR = "!4sII"  # Magic, number of OUIs, offset of the string table
+OUI_HDR_SIZ = struct.calcsize(OUI_HDR)
+OUI_REC_SIZ = 3 + 4  # OUI (24 bits), offset of its vendor in the table
+OUI_CACHE = 256  # Number of OUIs to remember the vendor of
+
+################
+# Capture File #
+################
+# Magic numbers read as little-endian: byte order of the records and the
+# resolution of their timestamps (us/ns)
+PCAP_MAGICS = {0xa1b2c3d4: ("<", 1e-6), 0xd4c3b2a1: (">", 1e-6),
+               0xa1b23c4d: ("<", 1e-9), 0x4d3cb2a1: (">", 1e-9)}
+PCAP_MAGIC = 0xa1b2c3d4  # Microsecond timestamps, written little-endian
+PCAP_HDR = "<IHHiIII"  # Magic, version, zone, accuracy, snap length, link
+PCAP_REC = "<IIII"  # Seconds, microseconds, captured and original length
+PCAP_HDR_SIZ = struct.calcsize(PCAP_HDR)
+PCAP_REC_SIZ = struct.calcsize(PCAP_REC)
+PCAPNG_SHB = 0x0a0d0d0a  # Section header block, same in both byte orders
+PCAPNG_BOM = 0x1a2b3c4d  # Byte-order magic of a section
+PCAPNG_IDB = 1  # Interface description block
+PCAPNG_PB = 2  # Packet block (obsolete)
+PCAPNG_SPB = 3  # Simple packet block
+PCAPNG_EPB = 6  # Enhanced packet block
+PCAPNG_TSRESOL = 9  # Interface option: resolution of the timestamps
+LINKTYPE_ETHERNET = 1  # Only link type the sniff pipeline can parse
+
+#############
+# Inventory #
+#############
+INV_TABLE = (
+    "CREATE TABLE IF NOT EXISTS hosts (ip TEXT, eth_mac TEXT, arp_mac TEXT, "
+    "eth_vendor TEXT, arp_vendor TEXT, first_seen REAL, last_seen REAL, "
+    "replies INTEGER, requests INTEGER, PRIMARY KEY (ip, eth_mac, arp_mac))"
+)
+INV_SELECT = "SELECT ip, eth_mac, arp_mac, eth_vendor, arp_vendor FROM hosts"
+INV_INSERT = "INSERT OR IGNORE INTO hosts VALUES (?, ?, ?, ?, ?, ?, ?, 0, 0)"
+INV_UPDATE = (
+    "UPDATE hosts SET last_seen = ?, replies = replies + ?, "
+    "requests = requests + ? WHERE ip = ? AND eth_mac = ? AND arp_mac = ?"
+)
 
 ###########
 # Signals #
@@ -43,61 +119,114 @@ STOP = 19  # SIGSTOP: Stop process
 
 CATCHABLE_SIGNALS = [_ for _ in range(1, 65) if _ not in [KILL, STOP, 32, 33]]
 CATCH_SIGNALS = [_ for _ in CATCHABLE_SIGNALS if _ not in [CHLD, WINCH]]
-IGNORE_SIGNALS = [_ for _ in CATCHABLE_SIGNALS if _ not in [HUP]]
+# Ignoring CHLD would reap the workers behind the back of is_alive()
+IGNORE_SIGNALS = [_ for _ in CATCHABLE_SIGNALS
+                  if _ not in [CHLD, HUP, WINCH]]
 
 #########
 # Names #
 #########
 # Threads
+COLLECT = "CollectThread"
 SEND = "SendThread"
 SNIFF = "SniffThread"
+WRITE = "WriteThread"
+STORE = "StoreThread"
+
+# Processes
+SEND_PROC = "SendProcess"
+SNIFF_PROC = "SniffProcess"
 
 # Handlers
+CHECKPOINT = "CheckpointHandler"
 ECHO = "EchoHandler"
+OUTPUT = "OutputHandler"
 PARSER = "ParserHandler"
 RESULT = "ResultHandler"
 SIGNAL = "SignalHandler"
 SOCKET = "SocketHandler"
+SOCKET_TX = "SocketHandlerTX"  # Dedicated socket for the transmit ring
 WINDOW = "WindowHandler"
 
 ##########################
 # Command-Line Arguments #
 ##########################
 # Links
+BAT = None  # Batch size
+BPS = None  # Bits per second
+BYP = None  # Qdisc bypass
+CHK = None  # Checkpoint
 CNT = None  # Count
+FAN = None  # Fanout
 FST = None  # Fast
+HIE = None  # Hierarchical
 FLT = None  # Filter
 INT = None  # Interface
+INV = None  # Inventory
 NOD = None  # Node
+OUT = None  # Output format
+OUF = None  # Output file
 PAS = None  # Passive
+PPS = None  # Packets per second
 RNG = None  # Range
+EXC = None  # Exclude
 REP = None  # Repeat
+RPL = None  # Replay
+RSM = None  # Resume
+RTY = None  # Retry
+RXM = None  # Receive mode
 SLP = None  # Sleep
 TIM = None  # Timeout
+TXM = None  # Transmit mode
+WRK = None  # Workers
+WRM = None  # Warm start
+WRF = None  # Write file
+WRS = None  # Write rotation size
+WRT = None  # Write rotation time
 
 # Defaults
+DEF_BAT = 64
 DEF_CNT = 1
+DEF_FAN = 0  # No sniffing workers, sniff in a thread
 DEF_NOD = 43
+DEF_OUF = "-"  # Standard output
 DEF_RNG = ["192.168.0.1/16", "172.16.0.1/16", "10.0.0.1/8"]
+DEF_RXM = "recv"
 DEF_SLP = 3  # In milliseconds
 DEF_TIM = float("inf")  # In seconds
+DEF_TXM = "send"
+DEF_WRK = 1
 
 # Minimums
+MIN_BAT = 1
+MIN_BPS = 1
 MIN_CNT = 1
+MIN_FAN = 0
 MIN_NOD = 2  # 0 for network
+MIN_PPS = 1
+MIN_RTY = 10
 MIN_SLP = 2
 MIN_TIM = 10
+MIN_WRK = 1
+MIN_WRS = 1  # In megabytes
+MIN_WRT = 10  # In seconds
 
 # Maximums
+MAX_BAT = 2 ** 12  # Half of the transmit ring
+MAX_FAN = 64
 MAX_NOD = 253  # 255 for broadcast
 MAX_SLP = 1000
+MAX_WRK = 64
+
+# Choices
+RX_MODES = ["recv", "ring", "batch"]  # Receive modes, first is the fallback
+TX_MODES = ["send", "ring"]  # Transmit modes, the first one is the fallback
+OUT_FORMATS = ["ndjson", "csv"]  # Output formats of the headless mode
 
 #################
 # Result Window #
 #################
 SEPARATOR = " | "
-CONT_STP_SIZ = 7  # Step size for the iterable sniff results container
-CONT_MAX_SIZ = ((256 ** 3) - 2 - 1) * CONT_STP_SIZ  # (/8 - [.0 + .255] - you)
 ETHER_TO_ARP = False  # Ethernet MAC <-> ARP MAC
 MAX_IP_LEN = 15
 MAX_MAC_LEN = 18
@@ -105,6 +234,7 @@ MAX_REP_LEN = 7
 MAX_REQ_LEN = 7
 ALL_COLUMNS = [MAX_IP_LEN, MAX_MAC_LEN, MAX_REP_LEN, MAX_REQ_LEN]
 MAX_ALL_LEN = sum(ALL_COLUMNS) + (len(ALL_COLUMNS) * len(SEPARATOR))
+DEF_SIZE = (80, 24)  # Columns and lines if the terminal size is unknown
 
 ######################
 # Layer 2 RAW Socket #
@@ -113,6 +243,56 @@ MIN_BUF = 42  # Minimum buffer size in bytes (14 for Ethernet, 28 for ARP)
 SOC_BUF = 42  # Buffer size in bytes
 SOC_POR = 0  # Port to bind to an interface (0 for automatic)
 SOC_PRO = 3  # GGP ( https://www.iana.org/assignments/protocol-numbers )
+POOL_NR = 256  # Number of preallocated buffers for the batch receive mode
+MAX_QUE = 2 ** 16  # Maximum number of sniff results waiting in the queue
+MAX_WRQ = 2 ** 18  # Maximum number of frames waiting to be written
+WRITE_BUF = 2 ** 20  # Write buffer of a capture file in bytes
+
+# Socket options ( /usr/include/linux/if_packet.h )
+SOL_PACKET = 263
+PACKET_RX_RING = 5
+PACKET_VERSION = 10
+PACKET_TX_RING = 13
+PACKET_FANOUT = 18
+PACKET_FANOUT_LB = 1  # Round-robin between the members of a fanout group
+PACKET_FANOUT_FLAG_IGNORE_OUTGOING = 0x4000  # Linux >= 6.8
+PACKET_QDISC_BYPASS = 20
+PACKET_IGNORE_OUTGOING = 23
+TPACKET_V2 = 1
+TPACKET_V3 = 2
+SO_ATTACH_FILTER = 26  # ( /usr/include/asm-generic/socket.h )
+
+# Classic BPF opcodes ( /usr/include/linux/filter.h )
+BPF_LDH_ABS = 0x28  # BPF_LD | BPF_H | BPF_ABS
+BPF_LDW_ABS = 0x20  # BPF_LD | BPF_W | BPF_ABS
+BPF_JEQ_K = 0x15  # BPF_JMP | BPF_JEQ | BPF_K
+BPF_RET_K = 0x06  # BPF_RET | BPF_K
+BPF_ACCEPT = 2 ** 18  # Snapshot length for accepted packets
+
+################
+# Receive Ring #
+################
+RING_BLK_SIZ = 2 ** 18  # Block size in bytes (a multiple of the page size)
+RING_BLK_NR = 16  # Number of blocks
+RING_FRM_SIZ = 2 ** 11  # Frame size in bytes
+RING_FRM_NR = (RING_BLK_SIZ // RING_FRM_SIZ) * RING_BLK_NR  # Number of frames
+RING_BLK_TOV = int(WAIT_SNIFF * 1000)  # Block retire timeout in milliseconds
+RING_BLK_STA = 8  # Offset of the block status in a block descriptor
+RING_BLK_PKT = 12  # Offset of the number of packets in a block descriptor
+TP_STATUS_KERNEL = 0  # Block is owned by the kernel
+TP_STATUS_USER = 1  # Block is owned by the user
+
+#################
+# Transmit Ring #
+#################
+TX_BLK_SIZ = 2 ** 12  # Block size in bytes (a multiple of the page size)
+TX_BLK_NR = 2 ** 8  # Number of blocks
+TX_FRM_SIZ = 2 ** 7  # Frame size in bytes (TPACKET_V2 header + request)
+TX_FRM_NR = (TX_BLK_SIZ // TX_FRM_SIZ) * TX_BLK_NR  # Number of frames
+TX_FRM_LEN = 4  # Offset of the packet length in a frame header
+TX_FRM_DAT = 32  # Offset of the packet in a frame
+TP_STATUS_AVAILABLE = 0  # Frame is free to be filled
+TP_STATUS_SEND_REQUEST = 1  # Frame is to be sent by the kernel
 
 ##################
 # Ethernet Frame #
@@ -130,9 +310,12 @@ ARP_HWS = "06"  # Hardware size: 6 bytes
 ARP_PRS = "04"  # Protocol size: 4 bytes
 ARP_REQ = "0001"  # Opcode: Request
 SND_MAC = None  # Sender MAC address
-SND_IP = None  # Sender IP address
 TGT_MAC = "ff" * 6  # Target MAC address: Broadcast
-TGT_IP = None  # Target IP address
+TGT_IP = None  # Target IP address (as an integer)
+
+# Offsets of the IP addresses patched into a request template
+SND_IP_OFF = 28  # Sender IP address
+TGT_IP_OFF = 38  # Target IP address
 
 
 #############
@@ -180,37 +363,182 @@ def add_dots(text, width, xref=0):
     return str(text)
 
 
-def check_ip(ip_addr, range_):
+def get_index(range_, align=1):
     """
-    Checks an IP address using the given scanning range.
+    Sorts the scanning intervals into an index to bisect, the intervals
+    never overlap so only the one that starts before an IP address can
+    contain it. Every interval also gets the offset of its first address,
+    as if all the intervals were laid end to end.
 
-    :param ip_addr: IP address to check.
-    :param range_: Scanning range.
+    :param range_: Scanning range as integer intervals.
+    :param align: Offsets are rounded up to a multiple of it.
     """
 
-    i = {"24": 3, "16": 2, "8": 1}  # Range slicing indexes by prefix length
+    range_ = sorted(range_)
 
-    return any(ip_addr.split(".")[:i[_[-1]]] == _[:i[_[-1]]] for _ in range_)
+    offsets = [0]
+    for first, last in range_:
+        offset = offsets[-1] + last - first + 1
+        offsets.append(-(-offset // align) * align)
 
+    return [_[0] for _ in range_], [_[1] for _ in range_], offsets
 
-def get_first_last(range_):
+
+def get_interval(range_, hosts=True):
     """
-    Determines the first/last IP address using the given scanning range.
+    Converts a CIDR range to an interval of IP addresses (as integers).
 
-    :param range_: Scanning range.
+    :param range_: Range in CIDR notation, e.g. 10.0.0.1/8.
+    :param hosts: True to leave out the network/broadcast address.
     """
 
-    if range_[-1] == "24":
-        first_ip = ".".join([range_[0], range_[1], range_[2], "1"])
-        last_ip = ".".join([range_[0], range_[1], range_[2], "254"])
-    elif range_[-1] == "16":
-        first_ip = ".".join([range_[0], range_[1], "0", "1"])
-        last_ip = ".".join([range_[0], range_[1], "255", "254"])
-    else:
-        first_ip = ".".join([range_[0], "0", "0", "1"])
-        last_ip = ".".join([range_[0], "255", "255", "254"])
+    ip_addr, prefix = range_.split("/")
+    size = 2 ** (32 - int(prefix))
+    first = struct.unpack("!I", socket.inet_aton(ip_addr))[0] // size * size
+
+    # Network/broadcast address only if there is a host address between
+    if hosts and size > 2:
+        return first + 1, first + size - 2
+    return first, first + size - 1
+
+
+def plan_ranges(range_, exclude):
+    """
+    Normalises the scanning ranges into integer intervals that never
+    overlap, never touch and leave out the excluded ranges, so that no
+    address is scanned twice. The intervals come in the order their
+    ranges were given, to start with the one the user has put first.
+
+    :param range_: Scanning ranges in CIDR notation.
+    :param exclude: Excluded ranges in CIDR notation.
+    """
+
+    merged = list()  # [First, last, index of the range given first]
+    for first, last, i in sorted(
+            get_interval(_) + (i,) for i, _ in enumerate(range_)):
+        # Overlapping or adjacent with the previous one?
+        if merged and first <= merged[-1][1] + 1:
+            merged[-1][1] = max(merged[-1][1], last)
+            merged[-1][2] = min(merged[-1][2], i)
+        else:
+            merged.append([first, last, i])
+
+    excluded = sorted(get_interval(_, hosts=False) for _ in exclude)
+
+    planned = list()
+    for first, last, i in merged:
+        for ex_first, ex_last in excluded:
+            if ex_last < first or ex_first > last:
+                continue
+            if ex_first > first:
+                planned.append((i, first, ex_first - 1))
+            first = ex_last + 1
+            if first > last:
+                break
+        if first <= last:
+            planned.append((i, first, last))
+
+    return [(_[1], _[2]) for _ in sorted(planned)]
+
+
+def get_targets(range_, shard=0, shards=1, expand=False, first=0):
+    """
+    Yields the target IP addresses (as integers) of a scanning range.
+
+    :param range_: Scanning range as an integer interval.
+    :param shard: Index of the contiguous shard of the range to be yielded.
+    :param shards: Number of shards the range is split into, every shard
+        but the last one is a multiple of 8 targets long.
+    :param expand: True to yield the rest of the answered /24 networks,
+        False to yield the priority nodes first (hierarchical mode only).
+    :param first: Lowest target to be yielded, to continue a shard.
+    """
+
+    start, stop = range_
+
+    size = -(-(stop - start + 1) // shards)  # Ceiling division
+    # Shards never share a byte of the bitmaps, as every range starts one
+    size = -(-size // 8) * 8
+    stop = min(stop, start + (shard + 1) * size - 1)
+    start += shard * size
+    start = max(start, first)  # After the sharding, shards stay the same
+
+    # Hierarchical mode? Probe only the priority nodes of every /24 first.
+    if HIE and not expand:
+        nodes = sorted(HIE)
+        for net in range(start >> 8, (stop >> 8) + 1):
+            for _ in nodes:
+                _ |= net << 8
+                if start <= _ <= stop:
+                    yield _
+        return
+
+    _ = start
+    while _ <= stop:
+        if HIE:
+            # Never answered? Skip the whole /24 network.
+            if not get_answered(_):
+                _ = (_ | 0xff) + 1
+                continue
+            # Priority nodes have already been probed
+            if (_ & 0xff) in HIE:
+                _ += 1
+                continue
+        # Fast mode only scans for specific hosts
+        elif FST and ((_ & 0xff) not in FAST_NODE):
+            _ += 1
+            continue
+        yield _
+        _ += 1
+
+
+def set_answered(ip_addr):
+    """
+    Marks the /24 network of an IP address as answered.
+
+    :param ip_addr: IP address as an integer.
+    """
+
+    net = ip_addr >> 8
+    ANSWERED[net >> 3] |= 1 << (net & 7)
+
+
+def get_answered(ip_addr):
+    """
+    Checks whether the /24 network of an IP address has answered.
+
+    :param ip_addr: IP address as an integer.
+    """
+
+    net = ip_addr >> 8
+    return (ANSWERED[net >> 3] >> (net & 7)) & 1
+
+
+def get_sender(tgt_ip):
+    """
+    Determines the sender IP address (as an integer) for a target.
+
+    :param tgt_ip: Target IP address as an integer.
+    """
+
+    tgt_ip_node = tgt_ip & 0xff
+    # Gratuitous ARP?
+    if tgt_ip_node == NOD:
+        return tgt_ip - tgt_ip_node
+    return tgt_ip - tgt_ip_node + NOD
+
+
+def finish(message):
+    """
+    Records a normal completion, the exit code is 0 unless there was an
+    error before.
+
+    :param message: Exit message.
+    """
 
-    return [first_ip, last_ip]
+    EXIT_MSGS.add(message)
+    if EXIT_CODE is None:
+        globals()["EXIT_CODE"] = 0
 
 
 def run_main(run, timed_out=False):
@@ -221,10 +549,8 @@ def run_main(run, timed_out=False):
     :param timed_out: True if timed out False otherwise.
     """
 
-    if (not run) or timed_out or (len(RESULT_ALL) > CONT_MAX_SIZ):
+    if (not run) or timed_out:
         if timed_out:
-            EXIT_MSGS.add("Exiting, timed out")
-        elif len(RESULT_ALL) > CONT_MAX_SIZ:
-            EXIT_MSGS.add("Exiting, no space left in the results container")
+            finish("Exiting, timed out")
 
         globals()["RUN_MAIN"] = False
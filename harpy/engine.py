@@ -0,0 +1,260 @@
+# coding=utf-8
+
+# This file is part of hARPy
+# Released under the MIT license
+# Copyright (C) Serhat Çelik
+
+import socket
+import collections
+from harpy import data
+from harpy.data import get_sender, get_targets
+from harpy.threads import SniffThread
+from harpy.handlers import (ArgumentHandler, HostHandler, InterfaceHandler,
+                            PacerHandler, PacketHandler, QueueHandler,
+                            ResultHandler, SocketHandler, StateHandler)
+
+try:
+    import asyncio
+except ImportError:
+    asyncio = None  # Python 2.7, only the threads are available
+
+
+def scan(interface, ranges=None, exclude=None, passive=False, fast=False,
+         count=1, rate=None, timeout=None):
+    """
+    Starts a scan on the running event loop and returns an asynchronous
+    iterator of the hosts as they are discovered:
+
+        async with scan("eth0", ["192.168.1.1/24"]) as hosts:
+            async for host in hosts:
+                print(host.ip, host.eth_mac, host.eth_vendor)
+
+    Leaving the block stops the scan, so does awaiting aclose().
+
+    The settings and the results live in the globals of harpy.data (RNG,
+    STATE, PACER, TGT_IP, RESULT_ALL...), as in the command line program,
+    so only one scan can run at a time in a process: start the next one
+    after the previous one has been closed.
+
+    :param interface: Network device to send/sniff packets.
+    :param ranges: Scanning ranges, the default ones if None.
+    :param exclude: Ranges not to be scanned.
+    :param passive: True to only sniff, never send any packets.
+    :param fast: True to only scan for specific hosts.
+    :param count: Number of times to send each request.
+    :param rate: Packets per second to send, 1000/DEF_SLP if None.
+    :param timeout: Seconds to stop the scan after, never if None.
+    """
+
+    if asyncio is None:
+        raise RuntimeError("The scan engine requires asyncio (Python 3)")
+
+    data.INT = interface
+    data.PAS = passive
+    data.FST = fast and not passive
+    data.FLT = None
+    data.REP = None
+    data.CNT = max(count, data.MIN_CNT)
+    data.NOD = data.DEF_NOD
+    data.SLP = data.DEF_SLP
+    data.BAT = data.DEF_BAT
+    data.PPS = rate
+    ArgumentHandler.handle_rate(data.PPS, None)
+    if ArgumentHandler.handle_range(ranges, exclude) is False:
+        raise ValueError("Problem with scanning range(s)")
+    data.STATE = StateHandler(data.RNG)
+
+    return ScanEngine(asyncio.get_event_loop(), timeout)
+
+
+class ScanEngine(object):
+    def __init__(self, loop, timeout=None):
+        self.loop = loop
+        self.closed = False
+        self.error = None  # Socket error that stopped the scan, if any
+
+        self.socket = SocketHandler(data.SOC_PRO)
+        self.socket.l2soc.setblocking(False)
+        self.socket.l2soc.bind((data.INT, data.SOC_POR))  # Raise, no exit
+        self.fd = self.socket.l2soc.fileno()  # Still known after closing
+        data.SRC_MAC = InterfaceHandler.get_mac(self.socket.l2soc)
+        data.SND_MAC = data.SRC_MAC
+        self.socket.set_filter(data.SRC_MAC)
+
+        # Only the parser of the sniff thread is used, it is never started
+        data.RESULT_A = QueueHandler(data.MAX_QUE)
+        self.sniffer = SniffThread(self.socket.l2soc)
+        self.buffer = bytearray(data.SOC_BUF)  # Reused for every packet
+        self.result = ResultHandler()
+        self.hosts = data.RESULT_ALL = HostHandler()
+
+        self.found = collections.deque()  # Hosts waiting for a consumer
+        self.waiters = collections.deque()  # Consumers waiting for a host
+
+        # Send/sniff only when the socket is ready, never sleep in between
+        self.loop.add_reader(self.fd, self.on_readable)
+        if not data.PAS:
+            data.PACER = self.pacer = PacerHandler(data.PPS, data.BAT)
+            self.template = PacketHandler.create_template()
+            self.requests = self.get_requests()
+            self.packet = None  # Request that could not be sent yet
+            self.delay = 0  # Debt of the pacer to be waited before sending
+            self.loop.add_writer(self.fd, self.on_writable)
+
+        if timeout is not None:
+            self.loop.call_later(timeout, self.close)
+
+    def __aiter__(self):
+        return self
+
+    def __anext__(self):
+        future = self.loop.create_future()
+        if self.found:
+            future.set_result(self.found.popleft())
+        elif self.closed:
+            future.set_exception(self.get_stop())
+        else:
+            self.waiters.append(future)
+        return future
+
+    def get_requests(self):
+        """Yields the request to be sent for every target, count times."""
+
+        state = data.STATE
+        for range_ in data.RNG:
+            start = state.find(range_[0]) - range_[0]  # Offset of IP 0
+            for _ in get_targets(range_):
+                data.TGT_IP = _
+                state.set(state.probed, start + _)
+                PacketHandler.patch_template(self.template, get_sender(_), _)
+                for _ in range(data.CNT):
+                    yield self.template
+        data.TGT_IP = False  # False means packet sending has finished
+
+    def on_writable(self):
+        for _ in range(data.BAT):
+            if self.packet is None:
+                self.packet = next(self.requests, None)
+                # All sent? Wait a while for the late replies, then stop.
+                if self.packet is None:
+                    self.loop.remove_writer(self.fd)
+                    self.loop.call_later(data.WAIT_MAIN, self.close)
+                    return
+
+            try:
+                self.socket.l2soc.send(self.packet)
+            except socket.error as err:
+                # 11: Resource temporarily unavailable
+                if err.args[0] == 11:
+                    return  # Called again when the socket is writable
+                return self.close(err)  # The consumers get the error
+            self.packet = None
+
+            self.pacer.take(1, self.defer)
+            if self.delay:
+                self.loop.remove_writer(self.fd)
+                self.loop.call_later(self.delay, self.resume)
+                self.delay = 0
+                return
+
+    def defer(self, delay):
+        """
+        Records the debt of the pacer instead of sleeping it.
+
+        :param delay: Seconds to wait before sending again.
+        """
+
+        self.delay = delay
+
+    def resume(self):
+        if not self.closed:
+            self.loop.add_writer(self.fd, self.on_writable)
+
+    def on_readable(self):
+        for _ in range(data.POOL_NR):
+            try:
+                size = self.socket.l2soc.recv_into(self.buffer)
+            except socket.error as err:
+                # 11: Resource temporarily unavailable
+                if err.args[0] == 11:
+                    break
+                return self.close(err)  # The consumers get the error
+            data.RX_FRAMES += 1
+            # Packet valid?
+            if size >= data.MIN_BUF:
+                self.sniffer.sniff(self.buffer)
+
+        for result in data.RESULT_A.drain():
+            known = len(self.hosts)
+            self.result.snd_ip = result[0]
+            self.result.src_mac = result[1]
+            self.result.snd_mac = result[2]
+            self.result.arp_opc = result[3]
+            self.result.stamp = result[4]
+            self.result(self.hosts)
+            # New host?
+            if len(self.hosts) > known:
+                self.publish(self.hosts.order[-1])
+
+    def publish(self, host):
+        """
+        Hands a new host to a waiting consumer, or keeps it until one comes.
+
+        :param host: Host that has been discovered.
+        """
+
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():  # Not cancelled by the consumer?
+                waiter.set_result(host)
+                return
+        self.found.append(host)
+
+    def close(self, error=None):
+        """
+        Stops the scan, consumers get the hosts found until now, then the
+        error if there is one.
+
+        :param error: Socket error that stopped the scan, None if no error.
+        """
+
+        if self.closed:
+            return
+        self.closed = True
+        self.error = error
+
+        self.loop.remove_reader(self.fd)
+        if not data.PAS:
+            self.loop.remove_writer(self.fd)
+        self.socket.close()
+
+        stop = error or StopAsyncIteration()  # pylint: disable=E0602
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_exception(stop)
+                self.error = None  # Delivered, the next ones just stop
+
+    def get_stop(self):
+        """Returns the exception that ends the iteration, the error once."""
+
+        if self.error is not None:
+            error, self.error = self.error, None
+            return error
+        return StopAsyncIteration()  # pylint: disable=E0602
+
+    def aclose(self):
+        """Stops the scan, awaitable like the one of async generators."""
+
+        self.close()
+        future = self.loop.create_future()
+        future.set_result(None)
+        return future
+
+    def __aenter__(self):
+        future = self.loop.create_future()
+        future.set_result(self)
+        return future
+
+    def __aexit__(self, *args):
+        return self.aclose()  # None, do not suppress the exception
@@ -9,16 +9,26 @@ import os
 import re
 import sys
 import json
+import mmap
+import time
+import bisect
 import signal
+import select
 import socket
 import struct
 import termios
 import argparse
 import binascii
+import collections
 import threading
-import subprocess
 from harpy import __license__, data
-from harpy.data import get_logo, get_banner, add_colons, add_dots, run_main
+
+try:
+    import ctypes
+except ImportError:
+    ctypes = None  # No in-kernel filtering, sniff() filters the packets
+from harpy.data import (get_logo, get_banner, add_colons, add_dots,
+                        get_index, plan_ranges, set_answered, run_main)
 
 
 class ExceptionHandler(object):
@@ -34,10 +44,12 @@ class ExceptionHandler(object):
                 if err.args[0] == 5:
                     # Mostly for "print" errors
                     pass
-                elif err.args[0] in (6, 9, 19, 100):
+                elif err.args[0] in (6, 9, 19, 28, 32, 100):
                     # 6: No such device or address
                     # 9: Bad file descriptor
                     # 19: No such device
+                    # 28: No space left on device
+                    # 32: Broken pipe
                     # 100: Network is down
                     self.add_exception(err.args[0], err.args[1])
                 else:
@@ -56,20 +68,95 @@ class ExceptionHandler(object):
         """
 
         data.EXIT_MSGS.add("%s -> [Errno %d] %s" % (self.who, errnum, error))
+        data.EXIT_CODE = 1
 
 
 class ArgumentHandler(object):
     def __init__(self):
         pass
 
+    @staticmethod
+    def handle_batch(batch):
+        if batch < data.MIN_BAT:
+            data.BAT = data.MIN_BAT
+        elif batch > data.MAX_BAT:
+            data.BAT = data.MAX_BAT
+
+    @staticmethod
+    def handle_checkpoint(checkpoint, resume):
+        if checkpoint is None:
+            # Resume is only allowed if a checkpoint is specified, so...
+            data.RSM = None
+            return True
+
+        directory = os.path.dirname(os.path.abspath(checkpoint))
+        if not os.access(directory, os.W_OK):
+            print("'%s': Cannot write the checkpoint" % checkpoint)
+            sys.stdout.flush()
+            return False
+        if not resume:
+            return True
+
+        try:
+            with open(checkpoint, "r") as state:
+                data.RESUME = json.load(state)
+            ranges, cursors = data.RESUME["ranges"], data.RESUME["cursors"]
+        except (IOError, OSError):
+            print("'%s': No checkpoint to resume from" % checkpoint)
+            sys.stdout.flush()
+            return False
+        except (ValueError, KeyError, TypeError):
+            print("'%s': Not a checkpoint" % checkpoint)
+            sys.stdout.flush()
+            return False
+        # Cursors only make sense for the same ranges split the same way,
+        # and swept in the same phases and rounds
+        if [tuple(_) for _ in ranges] != data.RNG or \
+                len(cursors) != (0 if data.PAS else data.WRK) or \
+                data.RESUME.get("modes") != CheckpointHandler.get_modes():
+            print("'%s': Checkpoint of another sweep (-r, -x, -p, -w, -H, "
+                  "-c, --retry?)" % checkpoint)
+            sys.stdout.flush()
+            return False
+        return True
+
     @staticmethod
     def handle_count(count):
         if count < data.MIN_CNT:
             data.CNT = data.MIN_CNT
 
+    @staticmethod
+    def handle_fanout(fanout):
+        if fanout < data.MIN_FAN:
+            data.FAN = data.MIN_FAN
+        elif fanout > data.MAX_FAN:
+            data.FAN = data.MAX_FAN
+
+    @staticmethod
+    def handle_hierarchical(hierarchical):
+        if hierarchical is not None:
+            # Nothing to expand in passive mode, so...
+            if data.PAS:
+                data.HIE = None
+                return
+            # No (valid) node given? Probe the ones of the fast mode first.
+            data.HIE = set(_ for _ in hierarchical if 0 <= _ <= 255)
+            data.HIE = data.HIE or set(data.FAST_NODE)
+            # Hierarchical mode expands what fast mode would skip, so...
+            data.FST = None
+
     @staticmethod
     @ExceptionHandler()
-    def handle_interface(interface):
+    def handle_interface(interface, replay):
+        # Nothing is sent or sniffed when replaying a capture file, so...
+        if replay is not None:
+            return True
+
+        # Probe only the given interface, or all of them once to pick one
+        members = InterfaceHandler(interface)
+        if interface is None:
+            data.INT = interface = members()
+
         if interface is False:
             print("No available interface in %s" % data.SYS_PATH)
             sys.stdout.flush()
@@ -78,16 +165,44 @@ class ArgumentHandler(object):
             print("'%s': This is not an Ethernet interface" % interface)
             sys.stdout.flush()
             return False
-        if interface not in InterfaceHandler().members:
+        if interface not in members.members:
             print("'%s': No such interface" % interface)
             sys.stdout.flush()
             return False
-        if InterfaceHandler().members[interface] != "up":
+        if members.members[interface] != "up":
             print("'%s': Interface is not available (dormant?)" % interface)
             sys.stdout.flush()
             return False
         return True
 
+    @staticmethod
+    def handle_inventory(inventory, warm):
+        if inventory is None:
+            # Warm start is only allowed if an inventory is specified, so...
+            data.WRM = None
+            return True
+
+        try:
+            import sqlite3  # Only with an inventory
+        except ImportError:
+            # Built without SQLite, so...
+            print("SQLite is not available, no inventory")
+            sys.stdout.flush()
+            return False
+        directory = os.path.dirname(os.path.abspath(inventory))
+        if not os.access(directory, os.W_OK):
+            print("'%s': Cannot write the inventory" % inventory)
+            sys.stdout.flush()
+            return False
+        # Create the table now, the store thread only has to write then
+        try:
+            InventoryHandler(inventory).close()
+        except sqlite3.Error:
+            print("'%s': Not an inventory" % inventory)
+            sys.stdout.flush()
+            return False
+        return True
+
     @staticmethod
     def handle_log():
         if os.path.isfile(data.LOG_FILE):
@@ -100,6 +215,41 @@ class ArgumentHandler(object):
         if not data.MIN_NOD <= node <= data.MAX_NOD:
             data.NOD = data.DEF_NOD
 
+    @staticmethod
+    def handle_output(output_file):
+        if data.OUT and output_file != data.DEF_OUF:
+            directory = os.path.dirname(os.path.abspath(output_file))
+            if not os.access(directory, os.W_OK):
+                print("'%s': Cannot write the output file" % output_file)
+                sys.stdout.flush()
+                return False
+        return True
+
+    @staticmethod
+    def handle_replay(replay):
+        if replay is not None:
+            try:
+                with open(replay, "rb") as capture:
+                    magic = capture.read(4)
+            except (IOError, OSError):
+                print("'%s': Cannot read the capture file" % replay)
+                sys.stdout.flush()
+                return False
+            magic = struct.unpack("<I", magic)[0] if len(magic) == 4 else 0
+            if magic != data.PCAPNG_SHB and magic not in data.PCAP_MAGICS:
+                print("'%s': Not a pcap/pcapng file" % replay)
+                sys.stdout.flush()
+                return False
+            # Replies are only read from the file, never asked for, so...
+            data.PAS = True
+            # No window without a terminal, stream the hosts instead
+            data.OUT = data.OUT or data.OUT_FORMATS[0]
+            # Packets of a capture file are already written, so...
+            data.WRF = None
+            # Nothing is swept in a capture file, so...
+            data.CHK = None
+        return True
+
     @staticmethod
     def handle_passive(passive):
         if passive:
@@ -108,29 +258,22 @@ class ArgumentHandler(object):
 
     @staticmethod
     @ExceptionHandler()
-    def handle_range(range_):
+    def handle_range(range_, exclude):
         if range_ is None:
             # Filtering is only allowed if a scanning range is specified, so...
             data.FLT = None
             # Repeat is only allowed if a scanning range is specified, so...
             data.REP = None
-            range_ = data.RNG = data.DEF_RNG
-
-        # Do this only if the scanning range is different from the default
-        if range_ != data.DEF_RNG:
-            octet = "([0-9]|[1-9][0-9]|1[0-9]{2}|2[0-4][0-9]|25[0-5])"
-            pattern = r"^({0}\.{0}\.{0}\.{0}/(8|16|24))$".format(octet)
+            range_ = data.DEF_RNG
 
-            set_range_ = list()
-            # Remove repetitive scanning ranges
-            for _ in range_:
-                if _ not in set_range_:
-                    set_range_.append(_)
-            range_ = set_range_
+        octet = "([0-9]|[1-9][0-9]|1[0-9]{2}|2[0-4][0-9]|25[0-5])"
+        prefix = "([0-9]|[12][0-9]|3[0-2])"
+        pattern = r"^({0}\.{0}\.{0}\.{0}/{1})$".format(octet, prefix)
 
-            problem = [_ for _ in range_ if not bool(re.search(pattern, _))]
+        for name, ranges in [("scanning", range_), ("excluded", exclude)]:
+            problem = [_ for _ in ranges or [] if not re.search(pattern, _)]
             if problem:
-                print("Problem with scanning range(s)", end=" -> ")
+                print("Problem with %s range(s)" % name, end=" -> ")
                 for i, _ in enumerate(problem):
                     # Last error?
                     if i == len(problem) - 1:
@@ -140,16 +283,31 @@ class ArgumentHandler(object):
                 sys.stdout.flush()
                 return False
 
-        data.RNG = [[
-            _.split(".")[0],
-            _.split(".")[1],
-            _.split(".")[2],
-            _.split(".")[-1].split("/")[0],
-            _.split(".")[-1].split("/")[-1],
-        ] for _ in range_]  # Convert the scanning range to list format
+        # Convert the scanning range to integer intervals
+        data.RNG = plan_ranges(range_, exclude or list())
 
         return True
 
+    @staticmethod
+    def handle_rate(pps, bps):
+        if pps is None:
+            if bps is None:
+                # Same rate as sleeping between each request
+                data.PPS = float(1000) / data.SLP
+            else:
+                data.PPS = float(max(bps, data.MIN_BPS)) / data.WIRE_BITS
+        elif pps < data.MIN_PPS:
+            data.PPS = data.MIN_PPS
+
+    @staticmethod
+    def handle_retry(retry):
+        if retry is not None:
+            # Nothing to retry in passive mode, so...
+            if data.PAS:
+                data.RTY = None
+            elif retry < data.MIN_RTY:
+                data.RTY = data.MIN_RTY
+
     @staticmethod
     def handle_sleep(sleep):
         if sleep < data.MIN_SLP:
@@ -162,6 +320,257 @@ class ArgumentHandler(object):
         if timeout < data.MIN_TIM:
             data.TIM = data.MIN_TIM
 
+    @staticmethod
+    def handle_workers(workers):
+        if workers < data.MIN_WRK:
+            data.WRK = data.MIN_WRK
+        elif workers > data.MAX_WRK:
+            data.WRK = data.MAX_WRK
+
+    @staticmethod
+    def handle_write(write, size, time_):
+        if write is not None:
+            directory = os.path.dirname(os.path.abspath(write))
+            if not os.access(directory, os.W_OK):
+                print("'%s': Cannot write the capture file" % write)
+                sys.stdout.flush()
+                return False
+            if size is not None and size < data.MIN_WRS:
+                data.WRS = data.MIN_WRS
+            if time_ is not None and time_ < data.MIN_WRT:
+                data.WRT = data.MIN_WRT
+        return True
+
+
+class CaptureHandler(object):
+    def __init__(self, path):
+        self.capture = None  # Memory-mapped capture file, None if empty
+        self.frames = 0  # Number of Ethernet frames read
+        self.stamp = None  # Capture time of the last frame read
+        self.eth_typ = binascii.unhexlify(data.ETH_TYP)  # Raw EtherType
+
+        with open(path, "rb") as capture:
+            try:
+                self.capture = mmap.mmap(capture.fileno(), 0,
+                                         access=mmap.ACCESS_READ)
+            except (ValueError, mmap.error):
+                return  # Empty file
+        # Read once from start to end, let the kernel read ahead (3.8+)
+        if hasattr(self.capture, "madvise"):
+            self.capture.madvise(mmap.MADV_SEQUENTIAL)
+
+    def __iter__(self):
+        """
+        Yields the offset and the capture time of every ARP frame, the others
+        are skipped before the sniff pipeline ever sees them.
+        """
+
+        if self.capture is None:
+            return iter(())
+        magic = struct.unpack_from("<I", self.capture)[0]
+        if magic == data.PCAPNG_SHB:
+            return self.walk_pcapng()
+        return self.walk_pcap(*data.PCAP_MAGICS[magic])
+
+    def walk_pcap(self, order, resolution):
+        """
+        Walks the records of a pcap file.
+
+        :param order: Byte order of the file, "<" or ">".
+        :param resolution: Seconds per unit of the timestamp fractions.
+        """
+
+        size = len(self.capture)
+        if size < data.PCAP_HDR_SIZ or struct.unpack_from(
+                order + "I", self.capture, 20
+        )[0] != data.LINKTYPE_ETHERNET:
+            return
+
+        # Timestamp, captured length and the EtherType of the frame after it,
+        # at once
+        record = struct.Struct(order + "III4x12x2s")
+        offset = data.PCAP_HDR_SIZ
+        while offset + record.size <= size:
+            sec, frac, length, eth_typ = record.unpack_from(self.capture,
+                                                            offset)
+            offset += data.PCAP_REC_SIZ
+            if offset + length > size:
+                break  # Truncated, still being written?
+            self.frames += 1
+            self.stamp = sec + frac * resolution
+            if length >= data.MIN_BUF and eth_typ == self.eth_typ:
+                yield offset, self.stamp
+            offset += length
+
+    def walk_pcapng(self):
+        """Walks the blocks of a pcapng file, section by section."""
+
+        size = len(self.capture)
+        order = "<"
+        linktypes = list()  # Link type of every interface of the section
+        resolutions = list()  # Seconds per timestamp unit of every interface
+        offset = 0
+        while offset + 12 <= size:
+            block = struct.unpack_from(order + "I", self.capture, offset)[0]
+            if block == data.PCAPNG_SHB:
+                bom = struct.unpack_from("<I", self.capture, offset + 8)[0]
+                order = "<" if bom == data.PCAPNG_BOM else ">"
+                linktypes = list()  # Interfaces are numbered per section
+                resolutions = list()
+            length = struct.unpack_from(order + "I", self.capture,
+                                        offset + 4)[0]
+            if length < 12 or offset + length > size:
+                break  # Corrupt or truncated
+
+            # Interface, timestamp, captured length and start of the packet
+            # data. No timestamp in a simple packet block, the last one holds.
+            if block == data.PCAPNG_EPB:
+                interface, high, low, captured = struct.unpack_from(
+                    order + "IIII", self.capture, offset + 8
+                )
+                start = offset + 28
+            elif block == data.PCAPNG_SPB:
+                interface, high, low, captured = 0, None, None, \
+                    struct.unpack_from(order + "I", self.capture,
+                                       offset + 8)[0]
+                start = offset + 12
+            elif block == data.PCAPNG_PB:
+                interface, high, low, captured = struct.unpack_from(
+                    order + "H2xIII", self.capture, offset + 8
+                )
+                start = offset + 28
+            else:
+                if block == data.PCAPNG_IDB:
+                    linktypes.append(struct.unpack_from(
+                        order + "H", self.capture, offset + 8
+                    )[0])
+                    resolutions.append(self.get_resolution(
+                        order, offset + 16, offset + length - 4
+                    ))
+                offset += length
+                continue
+
+            # Never read past the block, the captured length may lie (SPB)
+            captured = min(captured, offset + length - 4 - start)
+            if interface < len(linktypes) and \
+                    linktypes[interface] == data.LINKTYPE_ETHERNET:
+                self.frames += 1
+                if high is not None:
+                    self.stamp = (high << 32 | low) * resolutions[interface]
+                if captured >= data.MIN_BUF and self.capture[
+                        start + 12:start + 14] == self.eth_typ:
+                    yield start, self.stamp
+            offset += length
+
+    def get_resolution(self, order, offset, end):
+        """
+        Reads the resolution of the timestamps from the options of an
+        interface description block, microseconds if it has none.
+
+        :param order: Byte order of the section, "<" or ">".
+        :param offset: Offset of the first option.
+        :param end: Offset the options end at.
+        """
+
+        while offset + 4 <= end:
+            code, length = struct.unpack_from(order + "HH", self.capture,
+                                              offset)
+            if not code:
+                break  # End of options
+            if code == data.PCAPNG_TSRESOL and length >= 1:
+                value = bytearray(self.capture[offset + 4:offset + 5])[0]
+                # Negative power of 2 if the high bit is set, of 10 otherwise
+                if value & 0x80:
+                    return 2.0 ** -(value & 0x7f)
+                return 10.0 ** -value
+            offset += 4 + (length + 3) // 4 * 4  # Values padded to 32 bits
+        return 1e-6
+
+    def close(self):
+        if self.capture is not None:
+            self.capture.close()
+
+
+class CheckpointHandler(object):
+    def __init__(self, path):
+        self.path = path
+        self.time = time.time()  # Time of the last checkpoint
+
+    def mark(self):
+        """
+        Marks the hosts of the checkpoint resumed from as answered, so they
+        are neither retried nor left out when expanding.
+        """
+
+        for _ in data.RESUME["hosts"]:
+            ip_addr = struct.unpack("!I", socket.inet_aton(_[0]))[0]
+            if data.ANSWERED is not None:
+                set_answered(ip_addr)
+            offset = data.STATE.find(ip_addr)
+            if offset is not None:
+                data.STATE.set(data.STATE.answered, offset)
+
+    def restore(self, result, results):
+        """
+        Adds the hosts of the checkpoint resumed from to the host table.
+
+        :param result: Result handler to find the vendors with.
+        :param results: Host table to be restored.
+        """
+
+        for _ in data.RESUME["hosts"]:
+            host = Host(_[0], _[1], _[2], result.get_vendor(_[1]),
+                        result.get_vendor(_[2]))
+            results.add(host)
+            host.replies, host.requests = _[3], _[4]
+            results.replies += host.replies
+            results.requests += host.requests
+
+    def __call__(self, cursors, force=False):
+        """
+        Saves a checkpoint if the last one is old enough.
+
+        :param cursors: Cursors of the senders, shard by shard.
+        :param force: True to save it anyway (exiting).
+        """
+
+        if force or time.time() - self.time >= data.WAIT_CHECK:
+            self.time = time.time()
+            # Only exiting is worth dumping the whole host table for
+            self.save(cursors, force)
+
+    @staticmethod
+    def get_modes():
+        """
+        Returns what the cursors mean besides the ranges: the priority nodes
+        of the hierarchical mode, the retry delay and the count.
+        """
+
+        return [sorted(data.HIE) if data.HIE else None, data.RTY, data.CNT]
+
+    @ExceptionHandler(data.CHECKPOINT)
+    def save(self, cursors, hosts=True):
+        """
+        Replaces the checkpoint atomically, a crash never leaves half of it.
+
+        :param cursors: Cursors of the senders, shard by shard.
+        :param hosts: False to save the position only, without the hosts.
+        """
+
+        state = {
+            "ranges": data.RNG,
+            "modes": self.get_modes(),
+            "cursors": cursors,
+            "hosts": [[_.ip, _.eth_mac, _.arp_mac, _.replies, _.requests]
+                      for _ in data.RESULT_ALL] if hosts else [],
+        }
+        temp = self.path + ".tmp"
+        with open(temp, "w") as checkpoint:
+            json.dump(state, checkpoint)
+            checkpoint.flush()
+            os.fsync(checkpoint.fileno())
+        os.rename(temp, self.path)
+
 
 class EchoHandler(object):
     def __init__(self):
@@ -169,26 +578,35 @@ class EchoHandler(object):
 
     @ExceptionHandler()
     def enable(self):
-        """Enables terminal echo."""
+        """Enables terminal echo and line buffering."""
 
         new = termios.tcgetattr(self.descriptor)
-        new[3] |= termios.ECHO
+        new[3] |= termios.ECHO | termios.ICANON
         termios.tcsetattr(self.descriptor, termios.TCSANOW, new)
 
     @ExceptionHandler()
     def disable(self):
-        """Disables terminal echo."""
+        """Disables terminal echo and line buffering, keys can be read."""
 
         new = termios.tcgetattr(self.descriptor)
-        new[3] &= ~termios.ECHO
+        new[3] &= ~(termios.ECHO | termios.ICANON)
         termios.tcsetattr(self.descriptor, termios.TCSANOW, new)
 
 
 class InterfaceHandler(object):
     members = dict()  # All interfaces
 
-    def __init__(self):
-        if hasattr(socket, "if_nameindex"):
+    def __init__(self, interface=None):
+        """
+        Finds the interfaces and their states.
+
+        :param interface: Only interface to be probed, all if None.
+        """
+
+        if interface is not None:
+            if os.path.isdir(os.path.join(data.SYS_PATH, interface)):
+                self.members = {interface: None}
+        elif hasattr(socket, "if_nameindex"):
             if_nameindex = socket.if_nameindex()  # pylint: disable=E1101
             self.members = {_[-1]: None for _ in if_nameindex}
         else:
@@ -226,7 +644,159 @@ class InterfaceHandler(object):
         return binascii.hexlify(l2soc.getsockname()[-1]).decode("utf-8")
 
 
+class InventoryHandler(object):
+    def __init__(self, path):
+        import sqlite3  # Checked by handle_inventory, only loaded if used
+        self.error = sqlite3.Error
+        # A connection can only be used by the thread that has opened it
+        self.connection = sqlite3.connect(path)
+        # Readers never wait for the writer
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(data.INV_TABLE)
+        self.connection.commit()
+
+    def load(self):
+        """Returns the known hosts: (IP, Ethernet MAC, ARP MAC) -> vendors."""
+
+        return dict(((_[0], _[1], _[2]), (_[3], _[4]))
+                    for _ in self.connection.execute(data.INV_SELECT))
+
+    def store(self, new, seen):
+        """
+        Stores the hosts seen since the last call in one transaction, returns
+        False if the inventory could not be written (locked?).
+
+        :param new: Rows of the hosts to be inserted if unknown.
+        :param seen: Rows of the last seen times and the counter increments.
+        """
+
+        try:
+            with self.connection:
+                self.connection.executemany(data.INV_INSERT, new)
+                self.connection.executemany(data.INV_UPDATE, seen)
+        except self.error as err:
+            data.EXIT_MSGS.add("%s -> %s" % (data.STORE, err))
+            data.EXIT_CODE = 1
+            return False
+        return True
+
+    def close(self):
+        self.connection.close()
+
+
+class OutputHandler(object):
+    fields = ["event", "time", "ip", "eth_mac", "arp_mac", "replies",
+              "requests", "eth_vendor", "arp_vendor"]
+
+    def __init__(self, format_, path):
+        self.format = format_  # One of the output formats
+        self.file = sys.stdout if path == data.DEF_OUF else open(path, "w")
+        self.start = time.time()
+        self.end = None  # Time the scan ended at, now if None
+
+        self.pending = collections.OrderedDict()  # Hosts to be written
+        self.written = set()  # Hosts written at least once
+
+        self.writer = None  # CSV writer, only in the CSV format
+        if self.format == "csv":
+            import csv  # Not needed for the other formats
+            self.writer = csv.writer(self.file, lineterminator="\n")
+            self.writer.writerow(self.fields)
+
+    def add(self, host):
+        """
+        Marks a new or updated host to be written at the next flush.
+
+        :param host: Host seen by the result handler.
+        """
+
+        self.pending[id(host)] = host
+
+    @ExceptionHandler(data.OUTPUT)
+    def flush(self):
+        """Writes a line for every pending host, then the buffer at once."""
+
+        if not self.pending:
+            return
+
+        for host in self.pending.values():
+            if id(host) in self.written:
+                event = "update"
+            elif data.KNOWN is not None:
+                event = data.RESULT_ALL.get_diff(host)  # Warm start
+            else:
+                event = "new"
+            self.written.add(id(host))
+            self.write([event, round(host.last or time.time(), 3), host.ip,
+                        add_colons(host.eth_mac), add_colons(host.arp_mac),
+                        host.replies, host.requests, host.eth_vendor,
+                        host.arp_vendor])
+        self.pending.clear()
+
+        self.file.flush()
+
+    def write(self, row):
+        """
+        Writes a row as a CSV or JSON line.
+
+        :param row: Values of the fields.
+        """
+
+        if self.format == "csv":
+            self.writer.writerow(row)
+        else:
+            self.file.write(json.dumps(
+                collections.OrderedDict(zip(self.fields, row))
+            ) + "\n")
+
+    @ExceptionHandler(data.OUTPUT)
+    def close(self):
+        """Writes the pending hosts and a summary of the scan."""
+
+        self.flush()
+
+        # Warm start? Known hosts that have not answered this time are gone.
+        if data.KNOWN is not None:
+            now = round(self.end or time.time(), 3)
+            for _ in data.RESULT_ALL.get_gone():
+                self.write(["gone", now, _[0], add_colons(_[1]),
+                            add_colons(_[2]), 0, 0, data.KNOWN[_][0],
+                            data.KNOWN[_][1]])
+
+        summary = collections.OrderedDict([
+            ("event", "summary"),
+            ("time", round(self.end or time.time(), 3)),
+            ("duration", round(time.time() - self.start, 3)),
+            ("hosts", len(data.RESULT_ALL)),
+            ("replies", data.RESULT_ALL.replies),
+            ("requests", data.RESULT_ALL.requests),
+            ("targets", data.STATE.size),
+            ("probed", data.STATE.count(data.STATE.probed)),
+            ("answered", data.STATE.count(data.STATE.answered)),
+            ("retried", data.STATE.count(data.STATE.retried)),
+            ("dropped", data.RESULT_A.dropped),
+        ])
+        if data.KNOWN is not None:
+            summary["known"] = len(data.KNOWN)
+            summary["new"] = data.RESULT_ALL.diffs["new"]
+            summary["changed"] = data.RESULT_ALL.diffs["changed"]
+            summary["gone"] = len(data.KNOWN) - data.RESULT_ALL.diffs["known"]
+        # CSV rows have one layout, so the summary goes with the exit messages
+        if self.format == "csv":
+            data.EXIT_MSGS.add("Summary -> " + ", ".join(
+                "%s: %s" % _ for _ in list(summary.items())[1:]
+            ))
+        else:
+            self.file.write(json.dumps(summary) + "\n")
+
+        self.file.flush()
+        if self.file is not sys.stdout:
+            self.file.close()
+
+
 class PacketHandler(object):
+    templates = dict()  # (Source MAC, sender MAC) -> ARP request template
+
     def __init__(self):
         pass
 
@@ -249,11 +819,123 @@ class PacketHandler(object):
             binascii.unhexlify(data.ARP_PRS),
             binascii.unhexlify(data.ARP_REQ),
             binascii.unhexlify(data.SND_MAC),
-            socket.inet_aton(data.SND_IP),
+            b"\x00" * 4,  # Sender IP address, see patch_template
             binascii.unhexlify(data.TGT_MAC),
-            socket.inet_aton(data.TGT_IP),
+            b"\x00" * 4,  # Target IP address, see patch_template
         )
 
+    @classmethod
+    def create_template(cls):
+        """
+        Returns a reusable ARP request, built once per source/sender MAC
+        address, whose IP addresses are to be patched for every target.
+        """
+
+        key = (data.SRC_MAC, data.SND_MAC)
+        if key not in cls.templates:
+            cls.templates[key] = (cls.create_eth_frame()
+                                  + cls.create_arp_header())
+        return bytearray(cls.templates[key])
+
+    @staticmethod
+    def patch_template(template, snd_ip, tgt_ip):
+        """
+        Patches the IP addresses of a request template in place.
+
+        :param template: Request template to be patched.
+        :param snd_ip: Sender IP address as an integer.
+        :param tgt_ip: Target IP address as an integer.
+        """
+
+        struct.pack_into("!I", template, data.SND_IP_OFF, snd_ip)
+        struct.pack_into("!I", template, data.TGT_IP_OFF, tgt_ip)
+
+
+class PacerHandler(object):
+    clock = getattr(time, "monotonic", time.time)  # time.time for 2.7
+
+    def __init__(self, rate, burst, shared=None):
+        self.rate = float(rate)  # Target rate in packets per second
+        self.burst = burst  # Number of packets that can be sent at once
+        self.tokens = 0.0  # Packets that can be sent now, negative if owed
+        self.start = self.stamp = self.clock()
+        self.sent = 0  # Number of packets sent since the start
+        # Times and sent counts of the recent rate reads, oldest first
+        self.samples = collections.deque([(self.start, 0)])
+
+        # Tokens, stamp and sent shared by the processes of a global budget
+        self.shared = shared
+        if self.shared is not None:
+            self.shared[:] = [self.tokens, self.stamp, self.sent]
+
+    def take(self, count, wait):
+        """
+        Takes tokens for the given number of packets. Sleeps only if the
+        debt is long enough to be slept accurately, so very high rates are
+        released as short bursts instead of sub-millisecond sleeps.
+
+        :param count: Number of packets to be sent.
+        :param wait: Function to sleep with, e.g. Event.wait.
+        """
+
+        if self.shared is not None:
+            with self.shared.get_lock():
+                self.tokens, self.stamp, self.sent = self.shared[:]
+                self.refill(count)
+                self.shared[:] = [self.tokens, self.stamp, self.sent]
+        else:
+            self.refill(count)
+
+        # Sleep long enough?
+        if -self.tokens / self.rate >= data.WAIT_PACE:
+            wait(-self.tokens / self.rate)
+
+    def refill(self, count):
+        """
+        Refills the bucket for the time passed, then takes the tokens.
+
+        :param count: Number of packets to be sent.
+        """
+
+        now = self.clock()
+        self.tokens = min(
+            self.burst, self.tokens + (now - self.stamp) * self.rate
+        ) - count
+        self.stamp = now
+        self.sent += count
+
+    def get_rate(self):
+        """
+        Returns the achieved rate in packets per second over the last
+        WAIT_RATE seconds, so pauses long past do not drag it down.
+        """
+
+        if self.shared is not None:
+            self.sent = self.shared[-1]
+
+        now = self.clock()
+        self.samples.append((now, self.sent))
+        # Forget the reads older than the window, but the last one of them
+        while len(self.samples) > 2 and \
+                now - self.samples[1][0] >= data.WAIT_RATE:
+            self.samples.popleft()
+
+        stamp, sent = self.samples[0]
+        elapsed = now - stamp
+        return (self.sent - sent) / elapsed if elapsed > 0 else 0.0
+
+
+class LogAction(argparse.Action):
+    def __init__(self, option_strings, dest, **kwargs):
+        kwargs.update(nargs=0, default=argparse.SUPPRESS)
+        super(LogAction, self).__init__(option_strings, dest, **kwargs)
+
+    def __call__(self, parser, namespace, values, option_string=None):
+        # Read the log only when it is asked for
+        print(ArgumentHandler.handle_log())
+        sys.stdout.flush()
+        parser.exit()
+
 
 class ParserHandler(object):
     def __init__(self):
@@ -273,10 +955,37 @@ class ParserHandler(object):
             formatter_class=argparse.RawTextHelpFormatter,
         )
 
+        parser.add_argument(
+            "-b", default=data.DEF_BAT, type=int, metavar="batch", dest="b",
+            help="number of requests to queue before each transmit ring "
+                 "flush (def:%%(default)s|min:%d|max:%d)" % (data.MIN_BAT,
+                                                            data.MAX_BAT),
+        )
+        parser.add_argument(
+            "--bps", type=int, metavar="rate", dest="bps",
+            help="bits per second to send on the wire, overrides -s "
+                 "(min:%d)" % data.MIN_BPS,
+        )
+        parser.add_argument(
+            "--bypass", action="store_true", dest="bypass",
+            help="send the packets directly to the driver (qdisc bypass)",
+        )
+        parser.add_argument(
+            "--checkpoint", metavar="file", dest="checkpoint",
+            help="file to save the sweep position to every %d sec, and the "
+                 "hosts as well on exit" % data.WAIT_CHECK,
+        )
         parser.add_argument(
             "-c", default=data.DEF_CNT, type=int, metavar="count", dest="c",
-            help="number of times to send each request "
-                 "(def:%%(default)s|min:%d)" % data.MIN_CNT,
+            help="number of times to send each request, number of rounds "
+                 "with --retry (def:%%(default)s|min:%d)" % data.MIN_CNT,
+        )
+        parser.add_argument(
+            "--fanout", default=data.DEF_FAN, type=int, metavar="workers",
+            dest="fanout",
+            help="number of processes to share the sniffing between "
+                 "(def:%%(default)s|min:%d|max:%d)" % (data.MIN_FAN,
+                                                       data.MAX_FAN),
         )
         parser.add_argument(
             "-f", "--fast", action="store_true", dest="f",
@@ -287,16 +996,25 @@ class ParserHandler(object):
             help="filter the sniff results using the given scanning range",
         )
         parser.add_argument(
-            "-i", default=InterfaceHandler()(), metavar="interface", dest="i",
-            help="network device to send/sniff packets",
+            "-H", "--hierarchical", nargs="*", type=int, metavar="node",
+            dest="H",
+            help="enable hierarchical mode, probe the given nodes of every "
+                 "/24 first, then sweep the answered ones (def:fast nodes)",
+        )
+        parser.add_argument(
+            "-i", metavar="interface", dest="i",
+            help="network device to send/sniff packets (def:first one up)",
+        )
+        parser.add_argument(
+            "--inventory", metavar="file", dest="inventory",
+            help="SQLite file to store the hosts in across scans",
         )
         parser.add_argument(
             "-L", "--license", version=__license__.__doc__,
             action="version", help="show license and exit",
         )
         parser.add_argument(
-            "-l", "--log", action="version",
-            version=ArgumentHandler.handle_log(), help="show log and exit",
+            "-l", "--log", action=LogAction, help="show log and exit",
         )
         parser.add_argument(
             "-n", default=data.DEF_NOD, type=int, metavar="node", dest="n",
@@ -304,17 +1022,55 @@ class ParserHandler(object):
                  "(def:%%(default)s|min:%d|max:%d)" % (data.MIN_NOD,
                                                        data.MAX_NOD),
         )
+        parser.add_argument(
+            "-o", "--output", choices=data.OUT_FORMATS, metavar="format",
+            dest="o",
+            help="enable headless mode, stream the hosts instead of the "
+                 "result window, one of: %s" % ", ".join(data.OUT_FORMATS),
+        )
+        parser.add_argument(
+            "--output-file", default=data.DEF_OUF, metavar="file",
+            dest="output_file",
+            help="file to stream the hosts to in headless mode "
+                 "(def:stdout)",
+        )
         parser.add_argument(
             "-p", "--passive", action="store_true", dest="p",
             help="enable passive mode, do not send any packets",
         )
         parser.add_argument(
-            "-r", nargs="+", metavar="range", dest="r", help="scanning range",
+            "--pps", type=float, metavar="rate", dest="pps",
+            help="packets per second to send, overrides -s and --bps "
+                 "(min:%d)" % data.MIN_PPS,
+        )
+        parser.add_argument(
+            "-r", nargs="+", metavar="range", dest="r",
+            help="scanning range, any prefix length (e.g. 10.0.0.1/8)",
         )
         parser.add_argument(
             "-R", "--repeat", action="store_true", dest="R",
             help="enable repeat mode, never stop sending packets"
         )
+        parser.add_argument(
+            "--rx", default=data.DEF_RXM, choices=data.RX_MODES,
+            metavar="mode", dest="rx",
+            help="receive mode, one of: %s (def:%%(default)s)"
+                 % ", ".join(data.RX_MODES),
+        )
+        parser.add_argument(
+            "--replay", metavar="file", dest="replay",
+            help="replay a pcap/pcapng file instead of sniffing, implies -p "
+                 "and headless mode (def:-o %s)" % data.OUT_FORMATS[0],
+        )
+        parser.add_argument(
+            "--resume", action="store_true", dest="resume",
+            help="continue from the last checkpoint instead of starting over",
+        )
+        parser.add_argument(
+            "--retry", type=int, metavar="time", dest="retry",
+            help="time to wait before probing only the silent targets again "
+                 "in ms (min:%d)" % data.MIN_RTY,
+        )
         parser.add_argument(
             "-s", default=data.DEF_SLP, type=int, metavar="time", dest="s",
             help="time to sleep between each request in ms "
@@ -326,6 +1082,41 @@ class ParserHandler(object):
             help="timeout to stop scanning in sec "
                  "(def:%%(default)s|min:%d)" % data.MIN_TIM,
         )
+        parser.add_argument(
+            "--tx", default=data.DEF_TXM, choices=data.TX_MODES,
+            metavar="mode", dest="tx",
+            help="transmit mode, one of: %s (def:%%(default)s)"
+                 % ", ".join(data.TX_MODES),
+        )
+        parser.add_argument(
+            "-w", default=data.DEF_WRK, type=int, metavar="workers", dest="w",
+            help="number of processes to share the sending between "
+                 "(def:%%(default)s|min:%d|max:%d)" % (data.MIN_WRK,
+                                                       data.MAX_WRK),
+        )
+        parser.add_argument(
+            "--warm", action="store_true", dest="warm",
+            help="load the hosts of the inventory first and report the "
+                 "new, changed and gone ones",
+        )
+        parser.add_argument(
+            "--write", metavar="file", dest="write",
+            help="write the sniffed ARP packets to a pcap file",
+        )
+        parser.add_argument(
+            "--write-size", type=int, metavar="size", dest="write_size",
+            help="size to continue in a new pcap file after in MB "
+                 "(def:inf|min:%d)" % data.MIN_WRS,
+        )
+        parser.add_argument(
+            "--write-time", type=int, metavar="time", dest="write_time",
+            help="time to continue in a new pcap file after in sec "
+                 "(def:inf|min:%d)" % data.MIN_WRT,
+        )
+        parser.add_argument(
+            "-x", "--exclude", nargs="+", metavar="range", dest="x",
+            help="range not to be scanned, any prefix length",
+        )
         parser.add_argument(
             "-v", "--version", version="v" + __license__.VERSION,
             action="version", help="show program version and exit",
@@ -341,72 +1132,226 @@ class ParserHandler(object):
         :param commands: Parsed command-line arguments.
         """
 
+        data.BAT = commands.b
+        data.BPS = commands.bps
+        data.BYP = commands.bypass
+        data.CHK = commands.checkpoint
         data.CNT = commands.c
+        data.FAN = commands.fanout
         data.FST = commands.f
         data.FLT = commands.F
+        data.HIE = commands.H
         data.INT = commands.i
+        data.INV = commands.inventory
         data.NOD = commands.n
+        data.OUT = commands.o
+        data.OUF = commands.output_file
         data.PAS = commands.p
+        data.PPS = commands.pps
         data.RNG = commands.r
+        data.EXC = commands.x
         data.REP = commands.R
+        data.RSM = commands.resume
+        data.RPL = commands.replay
+        data.RTY = commands.retry
+        data.RXM = commands.rx
         data.SLP = commands.s
         data.TIM = commands.t
+        data.TXM = commands.tx
+        data.WRK = commands.w
+        data.WRM = commands.warm
+        data.WRF = commands.write
+        data.WRS = commands.write_size
+        data.WRT = commands.write_time
 
     @staticmethod
     def check_arguments():
         return False not in [
+            ArgumentHandler.handle_batch(data.BAT),
             ArgumentHandler.handle_count(data.CNT),
-            ArgumentHandler.handle_interface(data.INT),
+            ArgumentHandler.handle_fanout(data.FAN),
+            ArgumentHandler.handle_interface(data.INT, data.RPL),
+            ArgumentHandler.handle_inventory(data.INV, data.WRM),
             ArgumentHandler.handle_node(data.NOD),
+            ArgumentHandler.handle_replay(data.RPL),
+            ArgumentHandler.handle_output(data.OUF),
             ArgumentHandler.handle_passive(data.PAS),
-            ArgumentHandler.handle_range(data.RNG),
+            ArgumentHandler.handle_hierarchical(data.HIE),
+            ArgumentHandler.handle_retry(data.RTY),
+            ArgumentHandler.handle_range(data.RNG, data.EXC),
             ArgumentHandler.handle_sleep(data.SLP),
+            ArgumentHandler.handle_rate(data.PPS, data.BPS),
             ArgumentHandler.handle_timeout(data.TIM),
+            ArgumentHandler.handle_workers(data.WRK),
+            ArgumentHandler.handle_write(data.WRF, data.WRS, data.WRT),
+            ArgumentHandler.handle_checkpoint(data.CHK, data.RSM),
         ]
 
 
+class QueueHandler(object):
+    policy = "drop newest"  # What happens to an item when the queue is full
+
+    def __init__(self, size):
+        self.size = size  # Maximum number of items
+        self.items = collections.deque()
+        self.lock = threading.Lock()
+        self.dropped = 0  # Number of items dropped since the queue was full
+
+    def __len__(self):
+        return len(self.items)
+
+    def put(self, item):
+        """
+        Appends an item to the queue, drops it if the queue is full.
+
+        :param item: Item to be appended.
+        """
+
+        with self.lock:
+            if len(self.items) >= self.size:
+                self.dropped += 1
+                return False
+            self.items.append(item)
+        return True
+
+    def drain(self):
+        """Removes and returns all the items in the queue at once."""
+
+        with self.lock:
+            items, self.items = self.items, collections.deque()
+        return items
+
+
+class Host(object):
+    __slots__ = ("ip", "eth_mac", "arp_mac", "replies", "requests",
+                 "eth_vendor", "arp_vendor", "first", "last")
+
+    def __init__(self, ip, eth_mac, arp_mac, eth_vendor, arp_vendor):
+        self.ip = ip  # Sender IP address
+        self.eth_mac = eth_mac  # Source MAC address
+        self.arp_mac = arp_mac  # Sender MAC address
+        self.replies = 0
+        self.requests = 0
+        self.eth_vendor = eth_vendor  # Ethernet vendor
+        self.arp_vendor = arp_vendor  # ARP vendor
+        self.first = None  # Time the host was first seen at
+        self.last = None  # Time the host was last seen at
+
+
+class HostHandler(object):
+    def __init__(self):
+        self.hosts = dict()  # (IP, Ethernet MAC, ARP MAC) -> Host
+        self.order = list()  # Hosts in the order they were found
+        self.replies = 0  # Replies of all hosts
+        self.requests = 0  # Requests of all hosts
+
+        # Warm start? Compare every new host with the inventory.
+        self.diffs = collections.Counter()  # Difference -> number of hosts
+        self.known = None  # IP addresses of the inventory
+        if data.KNOWN is not None:
+            self.known = set(_[0] for _ in data.KNOWN)
+
+    def __len__(self):
+        return len(self.order)
+
+    def __iter__(self):
+        return iter(self.order)
+
+    def add(self, host):
+        """
+        Adds a new host to the table.
+
+        :param host: Host to be added.
+        """
+
+        self.hosts[(host.ip, host.eth_mac, host.arp_mac)] = host
+        self.order.append(host)
+        if self.known is not None:
+            self.diffs[self.get_diff(host)] += 1
+
+    def get_diff(self, host):
+        """
+        Compares a host with the inventory: "known", "changed" (known IP
+        address with other MAC addresses) or "new".
+
+        :param host: Host to be compared.
+        """
+
+        if (host.ip, host.eth_mac, host.arp_mac) in data.KNOWN:
+            return "known"
+        if host.ip in self.known:
+            return "changed"
+        return "new"
+
+    def get_gone(self):
+        """Yields the known hosts that have not been seen in this scan."""
+
+        for _ in data.KNOWN:
+            if _ not in self.hosts:
+                yield _
+
+    def count(self, host, reply):
+        """
+        Counts a reply/request of a host, keeps the running totals.
+
+        :param host: Host that sent the packet.
+        :param reply: True if the packet is a reply False otherwise.
+        """
+
+        if reply:
+            host.replies += 1
+            self.replies += 1
+        else:
+            host.requests += 1
+            self.requests += 1
+
+
 class ResultHandler(object):
     snd_ip = None
     src_mac = None
     snd_mac = None
     arp_opc = None
+    stamp = None  # Time the packet was received at, now if None
+    host = None  # Host of the last result
 
     def __init__(self):
         self.ouis = self.open_ouis()  # Get OUIs database
 
     def __call__(self, results):
-        for _ in range(0, len(results), data.CONT_STP_SIZ):
-            if (self.snd_ip in results) and (self.snd_ip == results[_]):
-                if self.src_mac == results[_ + 1]:
-                    if self.snd_mac == results[_ + 2]:
-                        if self.arp_opc != data.ARP_REQ:
-                            results[_ + 3] += 1
-                        else:
-                            results[_ + 4] += 1
-                        return results
-
-        results.append(self.snd_ip)  # Sender IP address
-        results.append(self.src_mac)  # Source MAC address
-        results.append(self.snd_mac)  # Sender MAC address
-        results.append(1 if self.arp_opc != data.ARP_REQ else 0)  # Reply
-        results.append(1 if self.arp_opc == data.ARP_REQ else 0)  # Request
-        results.append(self.get_vendor(self.src_mac))  # Ethernet vendor
-        results.append(self.get_vendor(self.snd_mac))  # ARP vendor
+        host = results.hosts.get((self.snd_ip, self.src_mac, self.snd_mac))
+        # New host?
+        if host is None:
+            host = Host(
+                self.snd_ip,
+                self.src_mac,
+                self.snd_mac,
+                self.get_vendor(self.src_mac),
+                self.get_vendor(self.snd_mac),
+            )
+            results.add(host)
+            ip_addr = struct.unpack("!I", socket.inet_aton(self.snd_ip))[0]
+            # Hierarchical mode? Expand the /24 network of the new host.
+            if data.ANSWERED is not None:
+                set_answered(ip_addr)
+            # Target? Do not probe it again in the retry rounds.
+            offset = data.STATE.find(ip_addr)
+            if offset is not None:
+                data.STATE.set(data.STATE.answered, offset)
+        results.count(host, self.arp_opc != data.ARP_REQ)
+        host.last = self.stamp or time.time()
+        if host.first is None:
+            host.first = host.last
+        self.host = host
 
         return results
 
     @staticmethod
     def open_ouis():
-        """Obtains the contents of the file that contains OUIs."""
+        """Maps the file that contains the OUI index."""
 
-        ouis_file = os.path.join(os.path.dirname(__file__), "ouis.json")
-        if os.path.isfile(ouis_file):
-            with open(ouis_file, "r") as ouis:
-                try:
-                    return json.load(ouis)
-                except ValueError:
-                    pass
-        return None
+        ouis = VendorHandler(os.path.join(os.path.dirname(__file__),
+                                          data.OUI_FILE))
+        return ouis if ouis.index is not None else None
 
     def get_vendor(self, mac):
         """
@@ -416,11 +1361,7 @@ class ResultHandler(object):
         """
 
         if self.ouis is not None:
-            if mac[:6] in self.ouis:
-                # Prevent the "ordinal not in range(128)" error in 2.7
-                # Also prevent for incorrect measurement of text length
-                return self.ouis[mac[:6]].encode("ascii", "ignore").decode()
-            return "unknown"
+            return self.ouis(mac[:6])
         return ""
 
 
@@ -451,6 +1392,8 @@ class SignalHandler(object):
 
 
 class SocketHandler(object):
+    ring = None  # TPACKET_V3 receive ring or TPACKET_V2 transmit ring
+
     def __init__(self, protocol):
         self.l2soc = socket.socket(
             socket.PF_PACKET, socket.SOCK_RAW, socket.htons(protocol)
@@ -472,107 +1415,463 @@ class SocketHandler(object):
 
         self.l2soc.bind((interface, port))
 
+    def set_ring(self):
+        """
+        Maps a TPACKET_V3 receive ring into memory, returns False if the
+        kernel does not support it so that the caller can fall back to recv.
+        """
+
+        try:
+            self.l2soc.setsockopt(
+                data.SOL_PACKET, data.PACKET_VERSION, data.TPACKET_V3
+            )
+            self.l2soc.setsockopt(
+                data.SOL_PACKET, data.PACKET_RX_RING, struct.pack(
+                    "7I",
+                    data.RING_BLK_SIZ,
+                    data.RING_BLK_NR,
+                    data.RING_FRM_SIZ,
+                    data.RING_FRM_NR,
+                    data.RING_BLK_TOV,
+                    0,  # Size of the private area
+                    0,  # Feature request word
+                )
+            )
+            self.ring = mmap.mmap(
+                self.l2soc.fileno(),
+                data.RING_BLK_SIZ * data.RING_BLK_NR,
+                mmap.MAP_SHARED,
+                mmap.PROT_READ | mmap.PROT_WRITE,
+            )
+        except (EnvironmentError, socket.error, mmap.error):
+            return False
+        return True
+
+    def set_tx_ring(self):
+        """
+        Maps a TPACKET_V2 transmit ring into memory, returns False if the
+        kernel does not support it so that the caller can fall back to send.
+        """
+
+        try:
+            self.l2soc.setsockopt(
+                data.SOL_PACKET, data.PACKET_VERSION, data.TPACKET_V2
+            )
+            self.l2soc.setsockopt(
+                data.SOL_PACKET, data.PACKET_TX_RING, struct.pack(
+                    "4I",
+                    data.TX_BLK_SIZ,
+                    data.TX_BLK_NR,
+                    data.TX_FRM_SIZ,
+                    data.TX_FRM_NR,
+                )
+            )
+            self.ring = mmap.mmap(
+                self.l2soc.fileno(),
+                data.TX_BLK_SIZ * data.TX_BLK_NR,
+                mmap.MAP_SHARED,
+                mmap.PROT_READ | mmap.PROT_WRITE,
+            )
+        except (EnvironmentError, socket.error, mmap.error):
+            return False
+        return True
+
+    def set_fanout(self, group):
+        """
+        Joins a fanout group so that the packets are shared between the
+        sockets of the group instead of being copied to each one.
+
+        :param group: Fanout group ID.
+        """
+
+        fanout = (group & 0xffff) | (data.PACKET_FANOUT_LB << 16)
+        # Outgoing packets are ignored by the group, not by its members
+        for flags in (data.PACKET_FANOUT_FLAG_IGNORE_OUTGOING, 0):
+            try:
+                self.l2soc.setsockopt(
+                    data.SOL_PACKET, data.PACKET_FANOUT, fanout | flags << 16
+                )
+            except socket.error:
+                continue
+            return True
+        return False
+
+    def set_bypass(self):
+        """Sends the packets directly to the driver, bypassing the qdisc."""
+
+        try:
+            self.l2soc.setsockopt(
+                data.SOL_PACKET, data.PACKET_QDISC_BYPASS, 1
+            )
+        except socket.error:
+            return False
+        return True
+
+    def set_filter(self, mac):
+        """
+        Attaches a classic BPF program that accepts only ARP frames not sent
+        from the given MAC address, and ignores the outgoing packets. Returns
+        False if the filter could not be attached.
+
+        :param mac: MAC address of the interface.
+        """
+
+        mac = binascii.unhexlify(mac)
+        mac_high = struct.unpack("!I", mac[:4])[0]
+        mac_low = struct.unpack("!H", mac[4:])[0]
+
+        program = [
+            (data.BPF_LDH_ABS, 0, 0, 12),  # EtherType
+            (data.BPF_JEQ_K, 0, 5, int(data.ETH_TYP, 16)),  # ARP or drop
+            (data.BPF_LDW_ABS, 0, 0, 6),  # Source MAC, first 4 bytes
+            (data.BPF_JEQ_K, 0, 2, mac_high),  # Yours or accept
+            (data.BPF_LDH_ABS, 0, 0, 10),  # Source MAC, last 2 bytes
+            (data.BPF_JEQ_K, 1, 0, mac_low),  # Yours, drop
+            (data.BPF_RET_K, 0, 0, data.BPF_ACCEPT),  # Accept
+            (data.BPF_RET_K, 0, 0, 0),  # Drop
+        ]
+
+        try:
+            # Outgoing packets never reach the receive queue (Linux >= 4.20)
+            self.l2soc.setsockopt(
+                data.SOL_PACKET, data.PACKET_IGNORE_OUTGOING, 1
+            )
+        except socket.error:
+            pass
+
+        if ctypes is None:
+            return False
+
+        # struct sock_filter { __u16 code; __u8 jt; __u8 jf; __u32 k; }
+        filters = ctypes.create_string_buffer(
+            b"".join(struct.pack("HBBI", *_) for _ in program)
+        )
+        # struct sock_fprog { unsigned short len; struct sock_filter *filter; }
+        fprog = struct.pack("HL", len(program), ctypes.addressof(filters))
+
+        try:
+            self.l2soc.setsockopt(
+                socket.SOL_SOCKET, data.SO_ATTACH_FILTER, fprog
+            )
+        except socket.error:
+            return False
+        return True
+
     def close(self):
+        if self.ring is not None:
+            self.ring.close()
         self.l2soc.close()
 
 
+class StateHandler(object):
+    def __init__(self, range_, create=bytearray, counter=list, shards=1):
+        # Starts, ends and offsets, every range starts a byte of a bitmap
+        self.index = get_index(range_, 8)
+        self.size = sum(_[1] - _[0] + 1 for _ in range_)  # Number of targets
+
+        # One bit for every target, in the order of the index
+        length = self.index[2][-1] // 8 + 1
+        self.probed = create(length)
+        self.answered = create(length)
+        self.retried = create(length)
+
+        # Bits set in probed, answered and retried, one row for every shard
+        # so that no two senders add to the same counter
+        self.counts = counter([0] * (3 * shards))
+
+    def find(self, ip_addr):
+        """
+        Finds the offset of an IP address in the bitmaps, None if it is not
+        a target.
+
+        :param ip_addr: IP address as an integer.
+        """
+
+        # The last interval that starts before the IP address, if any
+        i = bisect.bisect_right(self.index[0], ip_addr) - 1
+        if i >= 0 and ip_addr <= self.index[1][i]:
+            return self.index[2][i] + ip_addr - self.index[0][i]
+        return None
+
+    def set(self, bitmap, offset, shard=0):
+        """
+        Sets the bit of a target, counts it if it was not set.
+
+        :param bitmap: One of probed, answered or retried.
+        :param offset: Offset of the target.
+        :param shard: Shard of the sender setting the bit.
+        """
+
+        byte, bit = offset >> 3, 1 << (offset & 7)
+        if not bitmap[byte] & bit:
+            bitmap[byte] |= bit
+            self.counts[3 * shard + self.get_row(bitmap)] += 1
+
+    @staticmethod
+    def get(bitmap, offset):
+        """
+        Gets the bit of a target.
+
+        :param bitmap: One of probed, answered or retried.
+        :param offset: Offset of the target.
+        """
+
+        return (bitmap[offset >> 3] >> (offset & 7)) & 1
+
+    def count(self, bitmap):
+        """
+        Counts the targets whose bits are set, from the counters.
+
+        :param bitmap: One of probed, answered or retried.
+        """
+
+        return sum(self.counts[self.get_row(bitmap)::3])
+
+    def get_row(self, bitmap):
+        """
+        Gets the index of the counter of a bitmap in a row of counters.
+
+        :param bitmap: One of probed, answered or retried.
+        """
+
+        if bitmap is self.probed:
+            return 0
+        return 1 if bitmap is self.answered else 2
+
+
+class VendorHandler(object):
+    def __init__(self, path):
+        self.index = None  # Memory-mapped OUI index, None if unavailable
+        self.count = 0  # Number of OUIs
+        self.table = 0  # Offset of the vendor table
+        self.cache = collections.OrderedDict()  # Recent OUIs, oldest first
+
+        if os.path.isfile(path):
+            with open(path, "rb") as index:
+                try:
+                    self.index = mmap.mmap(index.fileno(), 0,
+                                           access=mmap.ACCESS_READ)
+                except (ValueError, mmap.error):
+                    return  # Empty file
+
+            magic, self.count, self.table = struct.unpack_from(
+                data.OUI_HDR, self.index
+            )
+            if magic != data.OUI_MAGIC:
+                self.index.close()
+                self.index = None
+
+    def __call__(self, oui):
+        """
+        Finds the vendor of an OUI, remembers the most recent ones.
+
+        :param oui: OUI as 6 hex digits.
+        """
+
+        vendor = self.cache.pop(oui, None)
+        if vendor is None:
+            vendor = self.find(oui)
+            # Cache full? Forget the least recently seen OUI.
+            if len(self.cache) >= data.OUI_CACHE:
+                self.cache.popitem(last=False)
+        self.cache[oui] = vendor
+
+        return vendor
+
+    def find(self, oui):
+        """
+        Binary searches the sorted records of the index for an OUI.
+
+        :param oui: OUI as 6 hex digits.
+        """
+
+        key = binascii.unhexlify(oui)
+
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            offset = data.OUI_HDR_SIZ + middle * data.OUI_REC_SIZ
+            current = self.index[offset:offset + 3]
+            if current < key:
+                low = middle + 1
+            elif current > key:
+                high = middle
+            else:
+                start = self.table + struct.unpack_from(
+                    "!I", self.index, offset + 3
+                )[0]
+                length = struct.unpack_from("B", self.index, start)[0]
+                return self.index[start + 1:start + 1 + length].decode()
+        return "unknown"
+
+
 class WindowHandler(object):
     logo = get_logo()
+    keys = {
+        # Key: (rows, pages) to scroll
+        b"\x1b[A": (-1, 0),  # Up
+        b"\x1b[B": (1, 0),  # Down
+        b"\x1b[5~": (0, -1),  # Page Up
+        b"\x1b[6~": (0, 1),  # Page Down
+        b"\x1b[H": (0, -2 ** 32),  # Home
+        b"\x1b[F": (0, 2 ** 32),  # End
+    }
 
     def __init__(self, results):
         self.results = results
 
-        self.col_length = self.get_column_length()
+        # Size unknown (the exception handler returns None)? Assume one.
+        self.columns, self.lines = self.get_size() or data.DEF_SIZE
+        self.resized = False  # Terminal size changed since the last frame
+        self.skeleton = list()  # Rows above the hosts, built at every step
+        self.screen = list()  # Rows on the terminal, to redraw only changes
+        self.top = 0  # Index of the first host in the viewport
 
-        self.banner = get_banner()
-        self.banner_results = [
-            len(list(_ for _ in range(0, len(results), data.CONT_STP_SIZ))),
-            sum(results[_] for _ in range(3, len(results), data.CONT_STP_SIZ)),
-            sum(results[_] for _ in range(4, len(results), data.CONT_STP_SIZ)),
-        ]
+        signal.signal(data.WINCH, self.resize)
 
-        for i, _ in enumerate(self.banner_results):
-            self.banner[i] += str(_)
+        # Start from an empty screen, draw the rows at their positions
+        sys.stdout.write("\x1b[?25l\x1b[H\x1b[2J")  # Also hide the cursor
 
     @ExceptionHandler()
-    def __call__(self):
-        for _ in range(0, len(self.results), data.CONT_STP_SIZ):
-            ip_address = self.results[_]
-            eth_mac_address = add_colons(self.results[_ + 1])
-            arp_mac_address = add_colons(self.results[_ + 2])
-            arp_rep = str(self.results[_ + 3])
-            rep_space_len = data.MAX_REP_LEN - len(arp_rep)
+    def __call__(self, step=True):
+        """
+        Redraws the rows that have changed since the last frame.
+
+        :param step: True to rebuild the skeleton, False to reuse it when
+            only scrolling or resizing.
+        """
+
+        if self.resized:
+            self.resized = False
+            # Size unknown? Keep the previous one.
+            self.columns, self.lines = (self.get_size()
+                                        or (self.columns, self.lines))
+            self.screen = list()  # Every row has to be redrawn
+            sys.stdout.write("\x1b[H\x1b[2J")
+
+        if step or not self.skeleton:
+            # Flip the MAC address column of the suspicious hosts
+            data.ETHER_TO_ARP = not data.ETHER_TO_ARP
+            self.skeleton = self.get_skeleton()
+
+        rows = self.skeleton + self.get_rows()
+        rows = [add_dots(_, self.columns) for _ in rows]
+
+        changes = list()
+        for i, _ in enumerate(rows):
+            if i >= len(self.screen) or self.screen[i] != _:
+                # Move to the row, write it, erase what is left of the old
+                changes.append("\x1b[%d;1H%s\x1b[K" % (i + 1, _))
+        for i in range(len(rows), len(self.screen)):
+            changes.append("\x1b[%d;1H\x1b[K" % (i + 1))
+        self.screen = rows
+
+        if changes:
+            sys.stdout.write("".join(changes))
+            sys.stdout.flush()
+
+    def resize(self, _signum, _frame):
+        self.resized = True
+
+    def poll(self):
+        """
+        Scrolls the hosts with the keys pressed since the last call, returns
+        True if the window has to be redrawn.
+        """
+
+        top = self.top
+        # Any key pressed? No need for Enter, line buffering is disabled.
+        if select.select([sys.stdin], [], [], 0)[0]:
+            pressed = os.read(sys.stdin.fileno(), 64)
+            for key, (rows, pages) in self.keys.items():
+                for _ in range(pressed.count(key)):
+                    self.top += rows + pages * self.get_height()
+            self.top = max(min(self.top, len(self.results) - 1), 0)
+
+        return self.resized or self.top != top
+
+    def close(self):
+        """Moves the cursor below the last row and shows it again."""
+
+        sys.stdout.write("\x1b[%d;1H\x1b[?25h" % (len(self.screen) + 1))
+        sys.stdout.flush()
+
+    def get_height(self):
+        """Returns the number of host rows that fit on the terminal."""
+
+        # Leave a row for the scroll position and one for the cursor, so the
+        # terminal itself never scrolls
+        return max(self.lines - len(self.skeleton) - 2, 1)
+
+    def get_rows(self):
+        """Formats the hosts in the viewport, nothing else."""
+
+        height = self.get_height()
+        self.top = max(min(self.top, len(self.results) - height), 0)
+
+        rows = list()
+        for _ in self.results.order[self.top:self.top + height]:
+            arp_rep = str(_.replies)
             # Prevent column distortion
-            arp_rep = str(float("inf")) if rep_space_len < 0 else arp_rep
-            arp_req = str(self.results[_ + 4])
-            req_space_len = data.MAX_REQ_LEN - len(arp_req)
-            arp_req = str(float("inf")) if req_space_len < 0 else arp_req
-            eth_vendor = self.results[_ + 5]
-            arp_vendor = self.results[_ + 6]
+            if len(arp_rep) > data.MAX_REP_LEN:
+                arp_rep = str(float("inf"))
+            arp_req = str(_.requests)
+            if len(arp_req) > data.MAX_REQ_LEN:
+                arp_req = str(float("inf"))
 
             # Suspicious packet?!
-            if eth_mac_address != arp_mac_address:
+            if _.eth_mac != _.arp_mac:
                 if data.ETHER_TO_ARP:
-                    mac_address = arp_mac_address + "!"
-                    vendor = arp_vendor
+                    mac_address = add_colons(_.arp_mac) + "!"
+                    vendor = _.arp_vendor
                 else:
-                    mac_address = eth_mac_address + "!"
-                    vendor = eth_vendor
+                    mac_address = add_colons(_.eth_mac) + "!"
+                    vendor = _.eth_vendor
             else:
-                mac_address = eth_mac_address
-                vendor = eth_vendor
-
-            print(ip_address.ljust(data.MAX_IP_LEN), end=data.SEPARATOR)
-            print(mac_address.ljust(data.MAX_MAC_LEN), end=data.SEPARATOR)
-            print(arp_rep.ljust(data.MAX_REP_LEN), end=data.SEPARATOR)
-            print(arp_req.ljust(data.MAX_REQ_LEN), end=data.SEPARATOR)
-            vendor = add_dots(vendor, self.col_length, data.MAX_ALL_LEN)
-            print(vendor)
-            sys.stdout.flush()
+                mac_address = add_colons(_.eth_mac)
+                vendor = _.eth_vendor
 
-    @staticmethod
-    @ExceptionHandler()
-    def get_column_length():
-        if hasattr(os, "get_terminal_size"):
-            return os.get_terminal_size().columns  # pylint: disable=E1101
-        return int(subprocess.check_output(["tput", "cols"]).strip())
+            rows.append(data.SEPARATOR.join([
+                _.ip.ljust(data.MAX_IP_LEN),
+                mac_address.ljust(data.MAX_MAC_LEN),
+                arp_rep.ljust(data.MAX_REP_LEN),
+                arp_req.ljust(data.MAX_REQ_LEN),
+                vendor,
+            ]))
 
-    @ExceptionHandler()
-    def draw_a_line(self):
-        print("-" * self.col_length)
-        sys.stdout.flush()
+        # More hosts than the viewport?
+        if len(self.results) > height:
+            rows.append("Hosts %d-%d of %d (Up/Down/PgUp/PgDn/Home/End)" % (
+                self.top + 1, self.top + len(rows), len(self.results),
+            ))
+
+        return rows
 
     @staticmethod
     @ExceptionHandler()
-    def draw_a_row(*args):
-        """
-        Draws a row for the result window.
+    def get_size():
+        if hasattr(os, "get_terminal_size"):
+            size = os.get_terminal_size()  # pylint: disable=E1101
+            return size.columns, size.lines
+        import subprocess  # Only for 2.7, only once per resize
+        return (int(subprocess.check_output(["tput", "cols"]).strip()),
+                int(subprocess.check_output(["tput", "lines"]).strip()))
 
-        :param args: Container that stores column texts.
-        """
+    def get_skeleton(self):
+        """Builds the rows above the hosts."""
 
-        for i, _ in enumerate(args):
-            # Last column?
-            if i == len(args) - 1:
-                print(_)
-                sys.stdout.flush()
-            else:
-                print(_, end=data.SEPARATOR)
+        banner = get_banner()
+        for i, _ in enumerate([len(self.results), self.results.replies,
+                               self.results.requests]):
+            banner[i] += str(_)
+
+        rows = list()
 
-    @ExceptionHandler()
-    def draw_skeleton(self):
         #################
         # Logo & Banner #
         #################
-        for i, j in zip(self.logo, self.banner):
-            print(i + (" " * (data.MAX_IP_LEN - len(i))), end=data.SEPARATOR)
-            print(j)
-        sys.stdout.flush()
-
-        ######################
-        # MAC Address Column #
-        ######################
-        data.ETHER_TO_ARP = not data.ETHER_TO_ARP
+        for i, j in zip(self.logo, banner):
+            rows.append(i.ljust(data.MAX_IP_LEN) + data.SEPARATOR + j)
 
         ########
         # Rows #
@@ -582,18 +1881,52 @@ class WindowHandler(object):
         elif data.TGT_IP is False:
             info_col = "Sending finished"
         else:
-            info_col = "Sending .%d -> %s" % (data.NOD, data.TGT_IP)
+            info_col = "Sending .%d -> %s (%d/%d pps)" % (
+                data.NOD, socket.inet_ntoa(struct.pack("!I", data.TGT_IP)),
+                data.PACER.get_rate(), data.PPS,
+            )
             if data.REP:
                 info_col = "R/" + info_col
 
-        self.draw_a_line()
-        self.draw_a_row("Ctrl+C to exit".ljust(data.MAX_IP_LEN), info_col)
-        self.draw_a_line()
-        self.draw_a_row(
+        line = "-" * self.columns
+        rows.append(line)
+        rows.append(data.SEPARATOR.join([
+            "Ctrl+C to exit".ljust(data.MAX_IP_LEN), info_col,
+        ]))
+        rows.append(data.SEPARATOR.join([
+            ("Receive: %s" % data.RXM).ljust(data.MAX_IP_LEN),
+            "Packets: %d" % data.RX_FRAMES,
+        ]))
+        rows.append(data.SEPARATOR.join([
+            ("Queue: %d" % data.RESULT_A.size).ljust(data.MAX_IP_LEN),
+            "Backlog: %d, dropped: %d (%s)" % (len(data.RESULT_A),
+                                               data.RESULT_A.dropped,
+                                               data.RESULT_A.policy),
+        ]))
+        rows.append(data.SEPARATOR.join([
+            ("Targets: %d" % data.STATE.size).ljust(data.MAX_IP_LEN),
+            "Probed: %d, answered: %d, retried: %d" % (
+                data.STATE.count(data.STATE.probed),
+                data.STATE.count(data.STATE.answered),
+                data.STATE.count(data.STATE.retried),
+            ),
+        ]))
+        if data.KNOWN is not None:
+            rows.append(data.SEPARATOR.join([
+                ("Known: %d" % len(data.KNOWN)).ljust(data.MAX_IP_LEN),
+                "New: %d, changed: %d, gone: %d" % (
+                    self.results.diffs["new"], self.results.diffs["changed"],
+                    len(data.KNOWN) - self.results.diffs["known"],
+                ),
+            ]))
+        rows.append(line)
+        rows.append(data.SEPARATOR.join([
             "IP Address".ljust(data.MAX_IP_LEN),
             "MAC Address".ljust(data.MAX_MAC_LEN),
             "Reply".ljust(data.MAX_REP_LEN),
             "Request".ljust(data.MAX_REQ_LEN),
             "Vendor",
-        )
-        self.draw_a_line()
+        ]))
+        rows.append(line)
+
+        return rows
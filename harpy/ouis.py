@@ -0,0 +1,113 @@
+# coding=utf-8
+
+# This file is part of hARPy
+# Released under the MIT license
+# Copyright (C) Serhat Çelik
+
+"""
+Builds the OUI index from the IEEE registry (oui.txt) or from a JSON file
+that maps OUIs to vendors:
+
+    python -m harpy.ouis oui.txt
+"""
+
+from __future__ import print_function
+import os
+import re
+import sys
+import json
+import struct
+import argparse
+import binascii
+from harpy import data
+
+
+def read_registry(path):
+    """
+    Reads the OUIs and their vendors from the IEEE registry.
+
+    :param path: Path of the registry, e.g. oui.txt.
+    """
+
+    pattern = re.compile(r"^\s*([0-9A-F]{2})-([0-9A-F]{2})-([0-9A-F]{2})"
+                         r"\s+\(hex\)\s+(.*?)\s*$", re.IGNORECASE)
+
+    ouis = dict()
+    with open(path, "rb") as registry:
+        for line in registry:
+            match = pattern.match(line.decode("utf-8", "ignore"))
+            if match:
+                ouis["".join(match.groups()[:3]).lower()] = match.group(4)
+    return ouis
+
+
+def read_json(path):
+    """
+    Reads the OUIs and their vendors from a JSON file.
+
+    :param path: Path of the JSON file, e.g. ouis.json.
+    """
+
+    with open(path, "r") as ouis:
+        return json.load(ouis)
+
+
+def write_index(ouis, path):
+    """
+    Writes the OUIs sorted as fixed-width records, followed by a table of
+    the vendors that the records point to. Every vendor is stored once.
+
+    :param ouis: OUI (as 6 hex digits) -> vendor.
+    :param path: Path of the index to be written.
+    """
+
+    records = bytearray()
+    table = bytearray()
+    offsets = dict()  # Vendor -> offset in the table
+    for oui in sorted(ouis):
+        # Prevent the "ordinal not in range(128)" error in 2.7
+        # Also prevent for incorrect measurement of text length
+        vendor = ouis[oui].lower().encode("ascii", "ignore")[:255]
+        if vendor not in offsets:
+            offsets[vendor] = len(table)
+            table += struct.pack("B", len(vendor)) + vendor
+        records += binascii.unhexlify(oui) + struct.pack("!I", offsets[vendor])
+
+    header = struct.pack(data.OUI_HDR, data.OUI_MAGIC, len(ouis),
+                         data.OUI_HDR_SIZ + len(records))
+
+    # Never leave a half-written index behind
+    with open(path + ".tmp", "wb") as index:
+        index.write(header + bytes(records) + bytes(table))
+    os.rename(path + ".tmp", path)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="python -m harpy.ouis",
+        description="Builds the OUI index of hARPy",
+    )
+    parser.add_argument(
+        "source", metavar="file",
+        help="IEEE registry (oui.txt) or JSON file (*.json) to read",
+    )
+    parser.add_argument(
+        "-o", metavar="index", dest="o",
+        default=os.path.join(os.path.dirname(__file__), data.OUI_FILE),
+        help="index to write (def:%(default)s)",
+    )
+    commands = parser.parse_args()
+
+    if commands.source.endswith(".json"):
+        ouis = read_json(commands.source)
+    else:
+        ouis = read_registry(commands.source)
+    if not ouis:
+        sys.exit("'%s': No OUI found" % commands.source)
+
+    write_index(ouis, commands.o)
+    print("%d OUIs -> %s" % (len(ouis), commands.o))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+# coding=utf-8
+
+# This file is part of hARPy
+# Released under the MIT license
+# Copyright (C) Serhat Çelik
+
+import multiprocessing
+from harpy import data
+from harpy.handlers import QueueHandler, SignalHandler, SocketHandler
+from harpy.threads import SendThread, SniffThread
+
+try:
+    import ctypes
+except ImportError:
+    ctypes = None  # Workers are not killed along with a crashed parent
+
+if hasattr(multiprocessing, "get_context"):
+    # Workers must inherit the links and the shared pacer, so always fork
+    context = multiprocessing.get_context("fork")
+else:
+    context = multiprocessing
+
+
+def set_parent_death_signal():
+    """Makes the kernel kill the calling process when its parent dies."""
+
+    if ctypes is not None:
+        try:
+            # 1: PR_SET_PDEATHSIG
+            ctypes.CDLL(None).prctl(1, data.KILL)
+        except (AttributeError, OSError):
+            pass
+
+
+class SendProcess(context.Process):
+    def __init__(self, shard, shards):
+        super(SendProcess, self).__init__()
+
+        self.shard = shard  # Index of the shard of every range
+        self.shards = shards  # Number of shards, one per worker
+        self.flag = context.Event()
+        self.cursor = context.RawArray("L", len(data.SWEPT))  # Position
+        if data.RESUME:
+            self.cursor[:] = data.RESUME["cursors"][shard]
+        self.daemon = True
+
+    def run(self):
+        # Only the main process handles signals, workers follow its flag
+        SignalHandler().ignore(*data.CATCHABLE_SIGNALS)
+        set_parent_death_signal()
+
+        # Every worker sends from its own socket, one that receives nothing
+        sender = SocketHandler(0)
+        sender.set_options()
+        sender.bind(data.INT, data.SOC_POR)
+        if data.TXM == "ring":
+            sender.set_tx_ring()
+        if data.BYP:
+            sender.set_bypass()
+
+        # Run the send loop in this process, no thread is needed
+        thread = SendThread(sender.l2soc, sender.ring)
+        thread.flag = self.flag
+        thread.shard = self.shard
+        thread.shards = self.shards
+        thread.cursor = self.cursor
+        thread.run()
+
+        sender.close()
+
+
+class SniffProcess(context.Process):
+    def __init__(self, group):
+        super(SniffProcess, self).__init__()
+
+        self.group = group  # Fanout group ID shared by all workers
+        self.flag = context.Event()
+        self.ready = context.Event()  # Set once sniffing, or failed to
+        self.reader, self.writer = context.Pipe(duplex=False)
+        self.daemon = True
+
+    def run(self):
+        # Only the main process handles signals, workers follow its flag
+        SignalHandler().ignore(*data.CATCHABLE_SIGNALS)
+        set_parent_death_signal()
+        self.reader.close()
+
+        sniffer = SocketHandler(data.SOC_PRO)
+        sniffer.set_options()
+        sniffer.bind(data.INT, data.SOC_POR)
+        sniffer.set_filter(data.SRC_MAC)
+        if data.RXM == "ring":
+            sniffer.set_ring()
+        # Not in the group? Every worker would get every packet, so...
+        if not sniffer.set_fanout(self.group):
+            self.writer.send("%s -> Cannot join the fanout group" % self.name)
+            self.writer.close()
+            sniffer.close()
+            self.ready.set()
+            return
+
+        # Sniff into a queue of this process, ship the queue to the parent
+        data.RESULT_A = QueueHandler(data.MAX_QUE)
+        if data.WRF:
+            data.WRITE_A = QueueHandler(data.MAX_WRQ)
+        thread = SniffThread(sniffer.l2soc, sniffer.ring)
+        thread.flag = self.flag
+        thread.start()
+        self.ready.set()
+
+        while not self.flag.wait(data.WAIT_SHIP):
+            self.ship()
+        thread.join()
+        self.ship()
+
+        self.writer.close()
+        sniffer.close()
+
+    def ship(self):
+        """Sends the counters and the results sniffed to the parent."""
+
+        results = data.RESULT_A.drain()
+        writes = data.WRITE_A.drain() if data.WRITE_A is not None else ()
+        if results or writes:
+            self.writer.send((data.RX_FRAMES, data.RESULT_A.dropped,
+                              list(results), list(writes)))
@@ -4,93 +4,260 @@
 # Released under the MIT license
 # Copyright (C) Serhat Çelik
 
+import os
+import time
+import select
 import socket
 import struct
 import binascii
 import threading
 from harpy import data
-from harpy.data import check_ip, get_first_last
-from harpy.handlers import ExceptionHandler, PacketHandler
+from harpy.data import get_sender, get_targets, run_main
+from harpy.handlers import ExceptionHandler, InventoryHandler, PacketHandler
+
+
+class CollectThread(threading.Thread):
+    def __init__(self, readers):
+        super(CollectThread, self).__init__()
+
+        self.readers = readers  # Pipes of the sniffing workers
+        self.flag = threading.Event()
+        self.frames = dict()  # Reader -> packets received by its worker
+        self.dropped = dict()  # Reader -> results dropped by its worker
+
+    @ExceptionHandler(data.COLLECT)
+    def run(self):
+        while self.readers and not self.flag.is_set():
+            for _ in select.select(self.readers, [], [], data.WAIT_SNIFF)[0]:
+                try:
+                    shipped = _.recv()
+                except EOFError:
+                    self.readers.remove(_)  # Worker has exited
+                    continue
+
+                # Worker has failed? Its error message ends the program.
+                if not isinstance(shipped, tuple):
+                    data.EXIT_MSGS.add(shipped)
+                    data.EXIT_CODE = 1
+                    run_main(False)
+                    continue
+
+                frames, dropped, results, writes = shipped
+                self.frames[_] = frames
+                data.RX_FRAMES = sum(self.frames.values())
+                # Count the drops of the workers with the ones of the parent
+                with data.RESULT_A.lock:
+                    data.RESULT_A.dropped += dropped - self.dropped.get(_, 0)
+                self.dropped[_] = dropped
+                for result in results:
+                    data.RESULT_A.put(result)
+                for write in writes:
+                    data.WRITE_A.put(write)
 
 
 class SendThread(threading.Thread):
-    def __init__(self, l2soc):
+    shard = 0  # Index of the shard of every range to be sent
+    shards = 1  # Number of shards every range is split into
+
+    def __init__(self, l2soc, ring=None):
         super(SendThread, self).__init__()
 
         self.l2soc = l2soc
+        self.ring = ring  # TPACKET_V2 transmit ring, None to use send
         self.flag = threading.Event()
 
+        # Expand phase, retry round, range index and target being sent,
+        # shared with the parent when sending in a worker
+        self.cursor = [0] * len(data.SWEPT)
+        if data.RESUME:
+            self.cursor[:] = data.RESUME["cursors"][self.shard]
+
+        self.frame = 0  # Index of the ring frame to be filled next
+        self.pending = 0  # Number of frames filled since the last flush
+
+        self.pacer = data.PACER
+
     def run(self):
+        # Resuming? Continue from the cursor of the checkpoint.
+        resume = data.RESUME["cursors"][self.shard] if data.RESUME else None
+
         while not self.flag.is_set():
-            for _ in data.RNG:
-                if self.flag.is_set():
-                    return
+            # Hierarchical mode? Probe the priority nodes, then expand.
+            for phase, expand in enumerate([False, True] if data.HIE
+                                           else [False]):
+                # Adaptive retries? Send once per round, count rounds.
+                for retry in range(data.CNT if data.RTY else 1):
+                    for index, range_ in enumerate(data.RNG):
+                        if self.flag.is_set():
+                            return
+
+                        first = 0  # Lowest target of the range to be sent
+                        if resume is not None:
+                            # Sent before the checkpoint? Skip it.
+                            if [phase, retry, index] < resume[:3]:
+                                continue
+                            first, resume = resume[3], None
+                        elif index == 0 and retry:
+                            # Wait for the late replies to the previous round
+                            self.flag.wait(float(data.RTY) / 1000)
+                        elif index == 0 and expand:
+                            # Wait for the late replies to the priority nodes
+                            self.flag.wait(data.WAIT_MAIN)
 
-                self.send(_)
+                        self.cursor[:] = [phase, retry, index, 0]
+                        # Stopped or failed? Resume from the cursor.
+                        if not self.send(range_, expand, retry, first):
+                            return
+
+            # The checkpoint only skips the ranges of the first pass, even
+            # a finished sweep is repeated from the start then
+            resume = None
 
             # No repeat?
             if not data.REP:
+                self.cursor[:] = data.SWEPT
                 break
 
         # Only works if repeat mode is not enabled
         data.TGT_IP = False  # False means packet sending has finished
 
     @ExceptionHandler(data.SEND)
-    def send(self, range_):
-        first_ip, last_ip = get_first_last(range_)
+    def send(self, range_, expand=False, retry=0, first=0):
+        """
+        Sends the targets of a range. Returns True only if the whole range
+        was sent, the exception handler returns None if sending failed.
 
-        start = struct.unpack("!I", socket.inet_aton(first_ip))[0]
-        stop = struct.unpack("!I", socket.inet_aton(last_ip))[0]
+        :param range_: Range to be sent.
+        :param expand: Only the expanded targets of hierarchical mode.
+        :param retry: Retry round, only the silent targets if not 0.
+        :param first: Lowest target of the range to be sent.
+        """
 
-        for _ in range(start, stop + 1):
+        template = PacketHandler.create_template()  # Reused for every target
+        count = 1 if data.RTY else data.CNT  # Rounds do the counting
+        state = data.STATE
+        start = state.find(range_[0]) - range_[0]  # Offset of IP address 0
+        for _ in get_targets(range_, self.shard, self.shards, expand, first):
             if self.flag.is_set():
                 return
 
-            data.TGT_IP = socket.inet_ntoa(struct.pack("!I", _))
+            # Retry round? Only the targets that have not answered yet.
+            if retry:
+                if state.get(state.answered, start + _):
+                    continue
+                state.set(state.retried, start + _, self.shard)
+            else:
+                state.set(state.probed, start + _, self.shard)
 
-            tgt_ip_node = int(data.TGT_IP.split(".")[3])
-            if data.FST and (tgt_ip_node not in data.FAST_NODE):
-                continue
+            data.TGT_IP = _
+            self.cursor[3] = _
 
-            new_count = data.CNT  # Restore the original at every step
+            PacketHandler.patch_template(template, get_sender(_), _)
+
+            new_count = count  # Restore the original at every step
             while (not self.flag.is_set()) and (new_count > 0):
-                tgt_ip_no_node = data.TGT_IP.split(".")[:3]
-                # Gratuitous ARP?
-                if tgt_ip_node == data.NOD:
-                    data.SND_IP = ".".join(tgt_ip_no_node + ["0"])
-                else:
-                    data.SND_IP = ".".join(tgt_ip_no_node + [str(data.NOD)])
+                if self.transmit(template):
+                    new_count -= 1
 
-                eth_frame = PacketHandler.create_eth_frame()
-                arp_header = PacketHandler.create_arp_header()
+        self.flush()  # Do not leave the last batch in the ring
+        return not self.flag.is_set()
 
-                try:
-                    self.l2soc.send(eth_frame + arp_header)  # Send the packet
-                except socket.error as err:
-                    # 11: Resource temporarily unavailable
-                    if err.args[0] == 11:
-                        self.flag.wait(data.WAIT_SEND)
-                    else:
-                        raise  # Go to except clause in the wrapper
-                else:
-                    new_count -= 1
-                    self.flag.wait(float(data.SLP) / 1000)  # Non-blocking wait
+    def transmit(self, packet):
+        """
+        Sends a packet, or queues it into the transmit ring if there is one.
+        Returns False if the packet has to be retried.
 
+        :param packet: Packet to be sent.
+        """
 
-class SniffThread(threading.Thread):
-    packet = None
+        if self.ring is not None:
+            return self.queue(packet)
+
+        try:
+            self.l2soc.send(packet)  # Send the packet
+        except socket.error as err:
+            # 11: Resource temporarily unavailable
+            if err.args[0] == 11:
+                self.flag.wait(data.WAIT_SEND)
+                return False
+            raise  # Go to except clause in the wrapper
+
+        self.pacer.take(1, self.flag.wait)  # Non-blocking wait
+        return True
+
+    def queue(self, packet):
+        """
+        Copies a packet into the next frame of the transmit ring, flushes the
+        ring once a whole batch is queued. Returns False if the ring is full.
+
+        :param packet: Packet to be queued.
+        """
+
+        offset = self.frame * data.TX_FRM_SIZ
+        # Frame not sent by the kernel yet?
+        if struct.unpack_from("I", self.ring,
+                              offset)[0] != data.TP_STATUS_AVAILABLE:
+            self.flush()
+            self.flag.wait(data.WAIT_SEND)
+            return False
+
+        start = offset + data.TX_FRM_DAT
+        self.ring[start:start + len(packet)] = bytes(packet)
+        struct.pack_into("I", self.ring, offset + data.TX_FRM_LEN, len(packet))
+        # Hand the frame over to the kernel after it has been filled
+        struct.pack_into("I", self.ring, offset, data.TP_STATUS_SEND_REQUEST)
+
+        self.frame = (self.frame + 1) % data.TX_FRM_NR
+        self.pending += 1
+        if self.pending >= data.BAT:
+            self.flush()
+        return True
+
+    def flush(self):
+        """Tells the kernel to send all the frames queued into the ring."""
 
-    def __init__(self, l2soc):
+        if not self.pending:
+            return
+
+        # Release the batch only when the pacer allows the whole of it
+        self.pacer.take(self.pending, self.flag.wait)
+        self.pending = 0
+
+        try:
+            self.l2soc.send(b"")  # One syscall for the whole batch
+        except socket.error as err:
+            # 11: Resource temporarily unavailable
+            if err.args[0] != 11:
+                raise  # Go to except clause in the wrapper
+
+
+class SniffThread(threading.Thread):
+    def __init__(self, l2soc, ring=None):
         super(SniffThread, self).__init__()
 
         self.l2soc = l2soc
+        self.ring = ring  # TPACKET_V3 receive ring, None to use recv
         self.flag = threading.Event()
 
+        # Raw forms of the values that sniff() compares with every packet
+        self.src_mac = binascii.unhexlify(data.SRC_MAC)
+        self.eth_typ = int(data.ETH_TYP, 16)
+
     @ExceptionHandler(data.SNIFF)
     def run(self):
+        if self.ring is not None:
+            self.walk_ring()
+        elif data.RXM == "batch":
+            self.recv_batch()
+        else:
+            self.recv_loop()
+
+    def recv_loop(self):
         while not self.flag.is_set():
+            packet = bytearray(data.SOC_BUF)  # A new buffer for every packet
             try:
-                self.packet = self.l2soc.recv(data.SOC_BUF)  # Receive a packet
+                # Receive a packet, get its length on the wire
+                length = self.l2soc.recv_into(packet, 0, socket.MSG_TRUNC)
             except socket.error as err:
                 # 11: Resource temporarily unavailable
                 if err.args[0] == 11:
@@ -98,24 +265,248 @@ class SniffThread(threading.Thread):
                 else:
                     raise
             else:
+                data.RX_FRAMES += 1
                 # Packet valid?
-                if len(self.packet) >= data.MIN_BUF:
-                    self.sniff()
-
-    def sniff(self):
-        # Ethernet frame from the packet
-        eth_frame = struct.unpack("!6s6s2s", self.packet[:14])
-        # ARP header from the packet
-        arp_header = struct.unpack("!2s2s1s1s2s6s4s6s4s", self.packet[14:42])
-
-        src_mac = binascii.hexlify(eth_frame[1]).decode("utf-8")
-        # Not your MAC address?
-        if src_mac != data.SRC_MAC:
-            eth_typ = binascii.hexlify(eth_frame[2]).decode("utf-8")
-            # EtherType ARP?
-            if eth_typ == data.ETH_TYP:
-                arp_opc = binascii.hexlify(arp_header[4]).decode("utf-8")
-                snd_mac = binascii.hexlify(arp_header[5]).decode("utf-8")
-                snd_ip = socket.inet_ntoa(arp_header[6])
-                if (not data.FLT) or (data.FLT and check_ip(snd_ip, data.RNG)):
-                    data.RESULT_A.append([snd_ip, src_mac, snd_mac, arp_opc])
+                if length >= data.MIN_BUF:
+                    self.sniff(packet, 0, length)
+
+    def recv_batch(self):
+        # Preallocated pool, every packet is received into its own slot
+        pool = bytearray(data.POOL_NR * data.SOC_BUF)
+        slots = [memoryview(pool)[_:_ + data.SOC_BUF]
+                 for _ in range(0, len(pool), data.SOC_BUF)]
+        sizes = [0] * data.POOL_NR
+
+        poller = select.poll()
+        poller.register(self.l2soc.fileno(), select.POLLIN | select.POLLERR)
+
+        while not self.flag.is_set():
+            count = 0  # Number of packets drained in this wakeup
+            for slot in slots:
+                try:
+                    # Length on the wire, even if the slot is shorter
+                    sizes[count] = self.l2soc.recv_into(slot, 0,
+                                                        socket.MSG_TRUNC)
+                except socket.error as err:
+                    # 11: Resource temporarily unavailable
+                    if err.args[0] == 11:
+                        break
+                    raise
+                count += 1
+
+            if not count:
+                poller.poll(data.WAIT_SNIFF * 1000)  # Wake up on readiness
+                continue
+
+            data.RX_FRAMES += count
+            for _ in range(count):
+                # Packet valid?
+                if sizes[_] >= data.MIN_BUF:
+                    self.sniff(pool, _ * data.SOC_BUF, sizes[_])
+
+    def walk_ring(self):
+        poller = select.poll()
+        poller.register(self.l2soc.fileno(), select.POLLIN | select.POLLERR)
+
+        block = 0  # Index of the block to be read next
+        while not self.flag.is_set():
+            offset = block * data.RING_BLK_SIZ
+            status = struct.unpack_from("I", self.ring,
+                                        offset + data.RING_BLK_STA)[0]
+            # Block still owned by the kernel?
+            if not status & data.TP_STATUS_USER:
+                poller.poll(data.WAIT_SNIFF * 1000)  # Wake up on readiness
+                continue
+
+            num_pkts, frame = struct.unpack_from("II", self.ring,
+                                                 offset + data.RING_BLK_PKT)
+            frame += offset
+            data.RX_FRAMES += num_pkts
+            for _ in range(num_pkts):
+                # Next offset, kernel timestamp, snapshot length, length on
+                # the wire and MAC offset of the frame
+                next_offset, sec, nsec, snap_len, length, mac = (
+                    struct.unpack_from("IIIII4xH", self.ring, frame)
+                )
+                # Packet valid?
+                if snap_len >= data.MIN_BUF:
+                    # Parse in place
+                    self.sniff(self.ring, frame + mac, length,
+                               sec + nsec / 1e9)
+                frame += next_offset
+
+            # Give the block back to the kernel
+            struct.pack_into("I", self.ring, offset + data.RING_BLK_STA,
+                             data.TP_STATUS_KERNEL)
+            block = (block + 1) % data.RING_BLK_NR
+
+    def sniff(self, packet, offset=0, length=None, stamp=None):
+        """
+        Parses a packet in place and stores the result if it is an ARP packet
+        that is not yours.
+
+        :param packet: Buffer that holds the packet.
+        :param offset: Offset of the packet in the buffer.
+        :param length: Length of the packet on the wire, if known.
+        :param stamp: Time the packet was received at, if known.
+        """
+
+        # Source MAC, EtherType, ARP opcode, sender MAC and sender IP
+        src_mac, eth_typ, arp_opc, snd_mac, snd_ip = struct.unpack_from(
+            "!6x6sH6xH6sI", packet, offset
+        )
+
+        # Not your MAC address and EtherType ARP?
+        if src_mac != self.src_mac and eth_typ == self.eth_typ:
+            # Filter on the raw sender IP, before converting anything
+            if (not data.FLT) or data.STATE.find(snd_ip) is not None:
+                src_mac = binascii.hexlify(src_mac).decode("utf-8")
+                snd_mac = binascii.hexlify(snd_mac).decode("utf-8")
+                snd_ip = socket.inet_ntoa(struct.pack("!I", snd_ip))
+                arp_opc = "%04x" % arp_opc
+                data.RESULT_A.put((snd_ip, src_mac, snd_mac, arp_opc, stamp))
+                # Keep a copy of the raw frame, the buffer is reused
+                if data.WRITE_A is not None:
+                    frame = packet[offset:offset + data.SOC_BUF]
+                    data.WRITE_A.put((stamp or time.time(),
+                                      length or len(frame), frame))
+
+
+class WriteThread(threading.Thread):
+    def __init__(self, path, size=None, time_=None):
+        super(WriteThread, self).__init__()
+
+        self.path = path
+        self.size = size  # Bytes to rotate the file after, never if None
+        self.time = time_  # Seconds to rotate the file after, never if None
+        self.flag = threading.Event()
+
+        self.file = None
+        self.index = 0  # Number of the current file, 0 for the first one
+        self.written = 0  # Bytes written to the current file
+        self.opened = 0  # Time the current file was opened
+        self.record = struct.Struct(data.PCAP_REC)
+
+    @ExceptionHandler(data.WRITE)
+    def run(self):
+        try:
+            self.rotate(time.time())
+            # Write in bulk, never while the sniff thread waits for a lock
+            while not self.flag.wait(data.WAIT_WRITE):
+                self.write()
+            self.write()  # Frames sniffed until the sniffing stopped
+        finally:
+            if self.file is not None:
+                self.file.close()
+            if data.WRITE_A.dropped:
+                data.EXIT_MSGS.add("Write queue was full, %d packets not "
+                                   "written" % data.WRITE_A.dropped)
+
+    def write(self):
+        """Writes the frames waiting in the queue, rotates the file if due."""
+
+        records = list()
+        for stamp, original, frame in data.WRITE_A.drain():
+            length = len(frame)
+            # File would be too big or is old enough? Continue in a new one.
+            if self.written > data.PCAP_HDR_SIZ and (
+                    (self.size and self.written + data.PCAP_REC_SIZ + length >
+                     self.size) or
+                    (self.time and stamp - self.opened >= self.time)
+            ):
+                self.file.write(b"".join(records))
+                records = list()
+                self.rotate(stamp)
+
+            records.append(self.record.pack(int(stamp),
+                                            int(stamp % 1 * 1000000),
+                                            length, original))
+            records.append(bytes(frame))
+            self.written += data.PCAP_REC_SIZ + length
+
+        if records:
+            self.file.write(b"".join(records))
+            self.file.flush()  # Readable while still sniffing
+
+    def rotate(self, opened):
+        """
+        Closes the current file, if any, and opens the next one.
+
+        :param opened: Time of the first packet of the new file.
+        """
+
+        if self.file is not None:
+            self.file.close()
+            self.index += 1
+
+        # Rotated files are numbered before the extension, like arp.1.pcap
+        path = self.path
+        if self.index:
+            root, ext = os.path.splitext(self.path)
+            path = "%s.%d%s" % (root, self.index, ext)
+
+        self.file = open(path, "wb", data.WRITE_BUF)
+        self.file.write(struct.pack(data.PCAP_HDR, data.PCAP_MAGIC, 2, 4, 0,
+                                    0, data.SOC_BUF, data.LINKTYPE_ETHERNET))
+        self.written = data.PCAP_HDR_SIZ
+        self.opened = opened
+
+
+class StoreThread(threading.Thread):
+    def __init__(self, path):
+        super(StoreThread, self).__init__()
+
+        self.path = path
+        self.flag = threading.Event()
+
+        self.hosts = dict()  # id(Host) -> Host seen but not stored yet
+        self.stored = dict()  # id(Host) -> (replies, requests) stored
+        self.pending = set()  # id(Host) of the hosts waiting in the queue
+
+    @ExceptionHandler(data.STORE)
+    def run(self):
+        inventory = InventoryHandler(self.path)
+        try:
+            # One transaction per round, never one per packet
+            while not self.flag.wait(data.WAIT_STORE):
+                self.store(inventory)
+            self.store(inventory)  # Hosts seen until the scan stopped
+        finally:
+            inventory.close()
+            if data.STORE_A.dropped:
+                data.EXIT_MSGS.add("Store queue was full, %d hosts not "
+                                   "stored" % data.STORE_A.dropped)
+
+    def store(self, inventory):
+        """
+        Stores the hosts seen since the last round, keeps them for the next
+        round if the inventory could not be written.
+
+        :param inventory: Inventory opened by this thread.
+        """
+
+        for _ in data.STORE_A.drain():
+            self.hosts[id(_)] = _
+            # Seen again from now on? Queued again, counters are read later.
+            self.pending.discard(id(_))
+        if not self.hosts:
+            return
+
+        now = time.time()
+        new, seen, counters = list(), list(), dict()
+        for key, host in self.hosts.items():
+            # Only the increments since the last round, the inventory sums up
+            replies, requests = self.stored.get(key, (None, None))
+            if replies is None:
+                new.append((host.ip, host.eth_mac, host.arp_mac,
+                            host.eth_vendor, host.arp_vendor,
+                            host.first or now, host.last or now))
+                replies = requests = 0
+            counters[key] = (host.replies, host.requests)
+            seen.append((host.last or now, counters[key][0] - replies,
+                         counters[key][1] - requests,
+                         host.ip, host.eth_mac, host.arp_mac))
+
+        if inventory.store(new, seen):
+            self.stored.update(counters)
+            self.hosts = dict()
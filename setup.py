@@ -45,7 +45,7 @@ setuptools.setup(
     keywords=["harpy", "arp", "discovery"],
     platforms=["Linux"],
     package_data={
-        "": ["*.conf", "*.json"],
+        "": ["*.conf", "*.idx"],
     },
     zip_safe=False,
     entry_points={